@@ -0,0 +1,37 @@
+<?php
+
+// This file is part of Moodle - http://moodle.org/
+//
+// Moodle is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+//
+// Moodle is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with Moodle.  If not, see <http://www.gnu.org/licenses/>.
+
+/**
+ * Rebuild the statistics of all pycode questions from the attempt history.
+ * Run once after upgrading to the incrementally maintained statistics
+ * (see progcode/stats.php), or at any time to correct them.
+ *
+ * Usage: php question/type/pycode/cli/backfill_stats.php
+ *
+ * @package    qtype
+ * @subpackage pycode
+ * @copyright  Richard Lobb, 2012, The University of Canterbury
+ * @license    http://www.gnu.org/copyleft/gpl.html GNU GPL v3 or later
+ */
+
+define('CLI_SCRIPT', true);
+
+require(dirname(__FILE__) . '/../../../../config.php');
+require_once($CFG->dirroot . '/question/type/pycode/progcode/stats.php');
+
+$count = qtype_progcode_stats::backfill('pycode');
+mtrace("Rebuilt statistics for $count pycode questions");
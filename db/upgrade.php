@@ -39,6 +39,82 @@ function xmldb_qtype_pycode_upgrade($oldversion) {
         upgrade_plugin_savepoint(true, 2012073001, 'qtype', 'pycode');
     }
 
+    // New version maintains question statistics incrementally, in two new
+    // tables, rather than computing them from the attempt steps. Existing
+    // statistics are rebuilt by cli/backfill_stats.php.
+    if ($oldversion < 2012073002) {
+        $table = new xmldb_table('question_pycode_stats');
+        $table->add_field('id', XMLDB_TYPE_INTEGER, '10', XMLDB_UNSIGNED, XMLDB_NOTNULL, XMLDB_SEQUENCE, null);
+        $table->add_field('questionid', XMLDB_TYPE_INTEGER, '10', XMLDB_UNSIGNED, XMLDB_NOTNULL, null, null);
+        foreach (array('attempts', 'successes', 'submissions') as $name) {
+            $table->add_field($name, XMLDB_TYPE_INTEGER, '10', XMLDB_UNSIGNED, XMLDB_NOTNULL, null, '0');
+        }
+        $table->add_field('gradingtime', XMLDB_TYPE_FLOAT, null, null, XMLDB_NOTNULL, null, '0');
+        foreach (array('correct', 'wrong', 'syntaxerrors', 'runtimeerrors', 'othererrors',
+                'likes', 'neutrals', 'dislikes') as $name) {
+            $table->add_field($name, XMLDB_TYPE_INTEGER, '10', XMLDB_UNSIGNED, XMLDB_NOTNULL, null, '0');
+        }
+        $table->add_key('primary', XMLDB_KEY_PRIMARY, array('id'));
+        $table->add_key('questionid', XMLDB_KEY_FOREIGN_UNIQUE, array('questionid'), 'question', array('id'));
+        if (!$dbman->table_exists($table)) {
+            $dbman->create_table($table);
+        }
+
+        $table = new xmldb_table('question_pycode_stat_users');
+        $table->add_field('id', XMLDB_TYPE_INTEGER, '10', XMLDB_UNSIGNED, XMLDB_NOTNULL, XMLDB_SEQUENCE, null);
+        $table->add_field('questionid', XMLDB_TYPE_INTEGER, '10', XMLDB_UNSIGNED, XMLDB_NOTNULL, null, null);
+        $table->add_field('userid', XMLDB_TYPE_INTEGER, '10', XMLDB_UNSIGNED, XMLDB_NOTNULL, null, null);
+        $table->add_field('submissions', XMLDB_TYPE_INTEGER, '10', XMLDB_UNSIGNED, XMLDB_NOTNULL, null, '0');
+        $table->add_field('succeeded', XMLDB_TYPE_INTEGER, '1', XMLDB_UNSIGNED, XMLDB_NOTNULL, null, '0');
+        $table->add_field('rating', XMLDB_TYPE_INTEGER, '1', XMLDB_UNSIGNED, XMLDB_NOTNULL, null, '0');
+        $table->add_key('primary', XMLDB_KEY_PRIMARY, array('id'));
+        $table->add_key('questionid', XMLDB_KEY_FOREIGN, array('questionid'), 'question', array('id'));
+        $table->add_index('questionid-userid', XMLDB_INDEX_UNIQUE, array('questionid', 'userid'));
+        if (!$dbman->table_exists($table)) {
+            $dbman->create_table($table);
+        }
+        upgrade_plugin_savepoint(true, 2012073002, 'qtype', 'pycode');
+    }
+
+    // New version counts the runs and failures of each test
+    if ($oldversion < 2012073003) {
+        $table = new xmldb_table('question_pycode_testcases');
+        $runs = new xmldb_field('runs', XMLDB_TYPE_INTEGER, '10', XMLDB_UNSIGNED, XMLDB_NOTNULL, null, '0');
+        $failures = new xmldb_field('failures', XMLDB_TYPE_INTEGER, '10', XMLDB_UNSIGNED, XMLDB_NOTNULL, null, '0');
+        if (!$dbman->field_exists($table, $runs)) {
+            $dbman->add_field($table, $runs);
+        }
+        if (!$dbman->field_exists($table, $failures)) {
+            $dbman->add_field($table, $failures);
+        }
+        upgrade_plugin_savepoint(true, 2012073003, 'qtype', 'pycode');
+    }
+
+    // New version never inserts statistics rows that may fail while grading:
+    // summary rows are created for every question up front, and the per-user
+    // rows lose their unique index (see progcode/stats.php).
+    if ($oldversion < 2012073004) {
+        require_once($CFG->dirroot . '/question/type/pycode/progcode/stats.php');
+        $table = new xmldb_table('question_pycode_stat_users');
+        $index = new xmldb_index('questionid-userid', XMLDB_INDEX_UNIQUE, array('questionid', 'userid'));
+        if ($dbman->index_exists($table, $index)) {
+            $dbman->drop_index($table, $index);
+        }
+        $index = new xmldb_index('questionid-userid', XMLDB_INDEX_NOTUNIQUE, array('questionid', 'userid'));
+        if (!$dbman->index_exists($table, $index)) {
+            $dbman->add_index($table, $index);
+        }
+        $questionids = $DB->get_fieldset_sql("
+                SELECT q.id
+                FROM {question} q
+                LEFT JOIN {question_pycode_stats} s ON s.questionid = q.id
+                WHERE q.qtype = 'pycode' AND s.id IS NULL");
+        foreach ($questionids as $questionid) {
+            qtype_progcode_stats::create_summary('pycode', $questionid);
+        }
+        upgrade_plugin_savepoint(true, 2012073004, 'qtype', 'pycode');
+    }
+
 
     return $result;
 }
@@ -44,6 +44,7 @@ $string['allornothing'] = 'Test code must be provided either for all testcases o
 $string['testcode'] = 'Test code';
 $string['stdin'] = 'Standard Input (only for programs that explicitly read stdin)';
 $string['failedhidden'] = 'Your code failed one or more hidden tests.';
+$string['graderunavailable'] = 'Your answer could not be graded just now, as the grader is busy or unavailable. Please try again shortly.';
 $string['filloutoneanswer'] = 'You must enter source code that satisfies the specification. The code you enter will be executed by an interpreter to determine its correctness and a grade awarded accordingly.';
 $string['hidden'] = 'Hidden';
 $string['display'] = 'Display';
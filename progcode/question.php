@@ -53,6 +53,7 @@ define('FUNC_MIN_LENGTH', 10);  /* Minimum no. of bytes for a valid bit of code
 require_once($CFG->dirroot . '/question/behaviour/adaptive/behaviour.php');
 require_once($CFG->dirroot . '/question/engine/questionattemptstep.php');
 require_once($CFG->dirroot . '/question/behaviour/adaptive_adapted_for_progcode/behaviour.php');
+require_once($CFG->dirroot . '/question/type/pycode/progcode/stats.php');
 
 /* Use the onlinejudge assignment module
  * (http://code.google.com/p/sunner-projects/wiki/OnlineJudgeAssignmentType)
@@ -66,6 +67,14 @@ require_once($CFG->dirroot . '/question/behaviour/adaptive_adapted_for_progcode/
 abstract class qtype_progcode_question extends question_graded_automatically {
 
     public $testcases;    // Array of testcases
+    public $gradingpriority = null;  // Overrides the default grading priority class
+
+    // Outcomes reporting a failure of the grading system rather than of the
+    // student's code, e.g. a grading worker that died or overran (see
+    // WORKER_FAILED in pycodePool.py). A grading with any of these is
+    // abandoned (see grade_response), so such results are never stored,
+    // reused or counted.
+    public static $systemoutcomes = array('Tester failed', 'Server busy');
 
     /**
      * Override default behaviour so that we can use a specialised behaviour
@@ -152,17 +161,33 @@ abstract class qtype_progcode_question extends question_graded_automatically {
     // It will still work with an unmodified behaviour but will be very
     // inefficient as multiple regradings will occur.
 
+    // Each cached test result is tagged with fingerprints of its test (see
+    // test_fingerprint) and expected output so that, if the testcases have
+    // been edited since, only the new or changed tests are rerun. Results
+    // of tests whose expected output alone has changed are re-evaluated by
+    // comparing their stored output with the new expected output.
+    // In fail-fast mode (see fail_fast) tests are run in decreasing order
+    // of their historical failure rate and testing stops at the first
+    // failure, so the results may cover only some of the testcases; each
+    // result's testindex field gives the position of its testcase.
+    // If the grader fails or is busy (see $systemoutcomes) the response
+    // isn't graded at all: a moodle_exception asks the student to try again.
+
     public function grade_response(array $response) {
+        $code = $response['answer'];
         if (empty($response['_testresults'])) {
             // debugging('Running ProgramCode tests');
-            $code = $response['answer'];
-            $testResults = $this->run_tests($code, $this->testcases);
-            $this->clean(&$testResults);  // Truncate if nec to fit in DB
+            $startTime = microtime(true);
+            $testResults = $this->update_results($code, array());
+            $gradingTime = microtime(true) - $startTime;
+            $this->check_grader_succeeded($testResults);
             $testResultsSerial = serialize($testResults);
+            $this->record_stats($response, $testResults, $gradingTime);
         }
         else {
-            $testResultsSerial = $response['_testresults'];
-            $testResults = unserialize($testResultsSerial);
+            $testResults = $this->update_results($code, unserialize($response['_testresults']));
+            $this->check_grader_succeeded($testResults);
+            $testResultsSerial = serialize($testResults);
         }
 
         $dataToCache = array('_testresults' => $testResultsSerial);
@@ -174,6 +199,18 @@ abstract class qtype_progcode_question extends question_graded_automatically {
         }
     }
 
+    // Throw a moodle_exception if any of the given test results has a
+    // system outcome, so the grading is abandoned rather than recorded.
+    private function check_grader_succeeded($testResults) {
+        foreach ($testResults as $tr) {
+            if (in_array($tr->outcome, self::$systemoutcomes)) {
+                throw new moodle_exception('graderunavailable', 'qtype_pycode', '', null,
+                        "{$tr->outcome}: {$tr->output}");
+            }
+        }
+    }
+
+
     // Check the correctness of a student's code given the
     // response and and a set of testCases.
     // Must be implemented by subclasses.
@@ -183,6 +220,204 @@ abstract class qtype_progcode_question extends question_graded_automatically {
     abstract protected function run_tests($code, $testcases);
 
 
+    // The priority class with which the grading server (if used) should
+    // grade this question: 'interactive' for a student waiting on a check,
+    // 'quizfinish' when a whole quiz attempt is being submitted, 'regrade'
+    // for bulk regrading (from the command line or the quiz reports) or
+    // 'validation' when an author is previewing the question. Set
+    // gradingpriority to override this.
+    protected function grading_priority() {
+        global $SCRIPT;
+        if (!empty($this->gradingpriority)) {
+            return $this->gradingpriority;
+        }
+        else if ((defined('CLI_SCRIPT') && CLI_SCRIPT) ||
+                optional_param('regrade', 0, PARAM_BOOL) ||
+                optional_param('regradeall', 0, PARAM_BOOL)) {
+            return 'regrade';
+        }
+        else if (isset($SCRIPT) && strpos($SCRIPT, '/question/preview.php') !== false) {
+            return 'validation';
+        }
+        else if (optional_param('finishattempt', 0, PARAM_BOOL)) {
+            return 'quizfinish';
+        }
+        else {
+            return 'interactive';
+        }
+    }
+
+
+    // Return the results of testing the given code with the current
+    // testcases, reusing those of the given previous results that are still
+    // valid and running only the tests that aren't. Results are in testcase
+    // order.
+    private function update_results($code, $oldResults) {
+        $stored = array();
+        foreach ($oldResults as $tr) {
+            if (isset($tr->fingerprint)) {
+                $stored[$tr->fingerprint] = $tr;
+            }
+        }
+
+        $testcases = array_values($this->testcases);
+        $order = $this->test_order($testcases);
+        $results = array();   // Indexed by testcase
+        $toRun = array();     // Testcases without valid results, by index, in run order
+        foreach ($order as $i) {
+            $testcase = $testcases[$i];
+            $fingerprint = $this->test_fingerprint($code, $testcase);
+            $tr = isset($stored[$fingerprint]) ? $this->reuse_result($stored[$fingerprint], $testcase) : null;
+            if ($tr === null) {
+                $toRun[$i] = $testcase;
+            }
+            else {
+                $tr = clone $tr;
+                $tr->testindex = $i;
+                $results[$i] = $tr;
+                if ($this->stops_testing($tr->outcome)) {
+                    break;
+                }
+            }
+        }
+
+        if (count($toRun) > 0) {
+            $newResults = $this->run_tests($code, array_values($toRun));
+            $this->clean(&$newResults);
+            $indices = array_keys($toRun);
+            foreach ($newResults as $j => $tr) {
+                $this->tag_result($code, $testcases, $indices[$j], $tr);
+                $results[$indices[$j]] = $tr;
+            }
+        }
+
+        // Reassemble the results in run order, ending where testing would
+        // have stopped, then sort them back into testcase order
+        $testResults = array();
+        foreach ($order as $i) {
+            if (!isset($results[$i])) {
+                break;
+            }
+            $testResults[$i] = $results[$i];
+            if ($this->stops_testing($results[$i]->outcome)) {
+                break;
+            }
+        }
+        ksort($testResults);
+        return array_values($testResults);
+    }
+
+
+    // Return the positions of the given testcases in the order the tests
+    // should be run: as given, except in fail-fast mode, where those most
+    // likely to fail (by their smoothed historical failure rates) come
+    // first.
+    private function test_order($testcases) {
+        $order = array_keys($testcases);
+        if (!$this->fail_fast()) {
+            return $order;
+        }
+        $keys = array();
+        foreach ($testcases as $i => $testcase) {
+            $runs = isset($testcase->runs) ? $testcase->runs : 0;
+            $failures = isset($testcase->failures) ? $testcase->failures : 0;
+            $keys[] = -($failures + 1.0) / ($runs + 2.0);
+        }
+        array_multisort($keys, SORT_NUMERIC, $order, SORT_NUMERIC);  // Ties by position
+        return $order;
+    }
+
+
+    // True if only the verdict is needed, not feedback on every test, so
+    // testing can stop at the first failure. Subclasses decide when.
+    protected function fail_fast() {
+        return false;
+    }
+
+
+    // Return the given stored result of a test, updated for the given
+    // (possibly edited) testcase, or null if the test must be rerun.
+    private function reuse_result($tr, $testcase) {
+        if (in_array($tr->outcome, self::$systemoutcomes)) {
+            return null;  // A system error, not a property of the code
+        }
+        else if ($tr->outcome == 'Timeout') {
+            return null;  // Depends on the load when it ran, so isn't cached either
+        }
+        else if ($tr->expectedhash == sha1($testcase->output)) {
+            return $tr;
+        }
+        else if (in_array($tr->outcome, array('Yes', 'No'))) {
+            if (!empty($tr->truncated)) {
+                return null;  // Not all the output is available to compare
+            }
+            $tr = clone $tr;
+            $tr->isCorrect = $this->outputs_match($tr->output, $testcase->output);
+            $tr->outcome = $tr->isCorrect ? 'Yes' : 'No';
+            $tr->expectedhash = sha1($testcase->output);
+            return $tr;
+        }
+        else {
+            return $tr;   // An error, whatever the expected output
+        }
+    }
+
+
+    // Tag the given result of running the testcase at the given position
+    // with that position and the fingerprints of its test and expected
+    // output.
+    private function tag_result($code, $testcases, $i, $tr) {
+        $tr->testindex = $i;
+        $tr->fingerprint = $this->test_fingerprint($code, $testcases[$i]);
+        $tr->expectedhash = sha1($testcases[$i]->output);
+    }
+
+
+    // A fingerprint of everything that determines the output of running
+    // the given testcase on the given code.
+    private function test_fingerprint($code, $testcase) {
+        $stdin = isset($testcase->stdin) ? $testcase->stdin : '';
+        return sha1(serialize(array($code, $testcase->testcode, $stdin)));
+    }
+
+
+    // True if a test with the given outcome ends the testing, as it does
+    // in the sandbox.
+    protected function stops_testing($outcome) {
+        if ($this->fail_fast()) {
+            return $outcome != 'Yes';
+        }
+        return !in_array($outcome, array('Yes', 'No'));
+    }
+
+
+    // True if the given output of a test matches the given expected output,
+    // as judged by the sandbox.
+    protected function outputs_match($output, $expected) {
+        return rtrim($output, "\n ") == rtrim($expected, "\n ");
+    }
+
+
+    // Add a newly-graded response's test outcomes to the run and failure
+    // counts of the testcases, which fail-fast ordering needs (see
+    // test_order), and, if COMPUTE_STATS is set, the response to the
+    // question's statistics (see progcode/stats.php), unless it's being
+    // regraded or the question is being previewed.
+    private function record_stats($response, $testResults, $gradingTime) {
+        global $USER;
+        if (in_array($this->grading_priority(), array('regrade', 'validation'))) {
+            return;
+        }
+        qtype_progcode_stats::record_test_outcomes($this->qtype->name(),
+                array_values($this->testcases), $testResults);
+        if (COMPUTE_STATS) {
+            $rating = isset($response['rating']) ? intval($response['rating']) : 0;
+            qtype_progcode_stats::record_grading($this->qtype->name(), $this->id,
+                    $USER->id, $testResults, $rating, $gradingTime);
+        }
+    }
+
+
     // Count the number of errors in the given array of test results.
     // TODO -- figure out how to eliminate either this one or the identical
     // version in renderer.php.
@@ -214,6 +449,7 @@ abstract class qtype_progcode_question extends question_graded_automatically {
         $maxLen = MAX_OUTPUT_LENGTH - strlen($suffix);
         if (strlen($output) > $maxLen) {
             $tr->output = substr($output, 0, $maxLen) . $suffix;
+            $tr->truncated = true;
         }
     }
 
@@ -42,7 +42,13 @@
  * @author 	Richard Lobb richard.lobb@canterbury.ac.nz
  */
 
-define('COMPUTE_STATS', false);
+require_once($CFG->dirroot . '/question/type/pycode/progcode/stats.php');
+
+define('COMPUTE_STATS', false);  // If TRUE, gradings are added to each question's statistics
+// Off by default, as each grading then updates its question's single summary
+// row, which contends under heavy load on a popular question. The per-test
+// run and failure counts used to order tests in fail-fast mode are kept
+// regardless (see record_stats in question.php).
 
 /**
  * qtype_progcode extends the base question_type to progcode-specific functionality.
@@ -136,6 +142,10 @@ class qtype_progcode extends question_type {
         foreach ($question->testcases as $tc) {
             if (($oldtestcase = array_shift($oldtestcases))) { // Existing testcase, so reuse it
                 $tc->id = $oldtestcase->id;
+                if ($tc->testcode != $oldtestcase->testcode || $tc->stdin != $oldtestcase->stdin ||
+                        $tc->output != $oldtestcase->output) {
+                    $tc->runs = $tc->failures = 0;  // A different test, with no history
+                }
                 $DB->update_record($table_name, $tc);
             } else {
                 // A new testcase
@@ -150,6 +160,7 @@ class qtype_progcode extends question_type {
             $DB->delete_records($table_name, array('id' => $otc->id));
         }
 
+        qtype_progcode_stats::create_summary($q_type, $question->id);
         return true;
     }
 
@@ -196,66 +207,17 @@ class qtype_progcode extends question_type {
         $q_type = $this->name();
         $table_name = "question_{$q_type}_testcases";
         $success = $DB->delete_records($table_name, array('questionid' => $questionid));
+        qtype_progcode_stats::delete($q_type, $questionid);
         return $success && parent::delete_question($questionid, $contextid);
     }
 
 
 
-    // Query the database to get the statistics of attempts and ratings for
-    // a given question.
+    // Get the statistics of attempts, ratings and outcomes for a given
+    // question. These are maintained as each submission is graded (see
+    // stats.php) so this is a single-row lookup.
     private function get_question_stats($question_id) {
-        // TODO: this query kills the DB server! If stats gathering is to
-        // be turned on again it must be restructured, e.g. have the subquery
-        // filter by attemptstepid rather than name, then select subset with
-        // right name.
-        global $DB;
-        $attempts = $DB->get_records_sql("
-            SELECT questionattemptid, fraction, rating, sequencenumber
-            FROM mdl_question_attempts as qa,
-                        mdl_question_attempt_steps as qas
-            LEFT JOIN
-                ( SELECT value as rating, attemptstepid
-                  FROM  mdl_question_attempt_step_data
-                  WHERE name = 'rating'
-                ) as qasd
-            ON qasd.attemptstepid = qas.id
-            WHERE questionattemptid = qa.id
-
-            AND questionid = ?
-            AND qas.sequencenumber =
-                ( SELECT max(mdl_question_attempt_steps.sequencenumber)
-                  FROM mdl_question_attempt_steps
-                  WHERE mdl_question_attempt_steps.questionattemptid = qa.id
-                )",
-            array($question_id));
-
-        $num_attempts = 0;
-        $num_successes = 0;
-        $counts = array(0, 0, 0, 0);
-        $num_steps = 0;
-        foreach ($attempts as $attempt) {
-            $rating = isset($attempt->rating) ? $attempt->rating : 0;
-            $counts[$rating]++;
-            if ($attempt->fraction > 0.0) {
-                $num_successes++;
-            }
-            if ($attempt->sequencenumber > 0) {
-                $num_attempts++;
-                $num_steps += $attempt->sequencenumber;
-            }
-        }
-
-        $success_percent = $num_attempts == 0 ? 0 : intval(100.0 * $num_successes / $num_attempts);
-        $average_retries = $num_attempts == 0 ? 0 : $num_steps / $num_attempts;
-        $stats = (object) array(
-            'question_id' => $question_id,
-            'attempts'    => $num_attempts,
-            'success_percent' => $success_percent,
-            'average_retries' => $average_retries,
-            'likes'    => $counts[1],
-            'neutrals' => $counts[2],
-            'dislikes' => $counts[3]);
-        return $stats;
+        return qtype_progcode_stats::get($this->name(), $question_id);
     }
 
 
@@ -30,10 +30,9 @@ define('MAX_LINE_LENGTH', 120);
 define('MAX_NUM_LINES', 200);
 
 define('SHOW_STATISTICS', FALSE);  // If TRUE, shows stats on all progcode-type questions
-// Warning! For this to be workable, COMPUTE_STATS in questiontype.php must be
-// true. The feature has been disabled as it brings the database server to its
-// knees when there are large numbers of question submissions to compute stats
-// from.
+// COMPUTE_STATS in questiontype.php must also be true. The statistics are
+// maintained incrementally as submissions are graded (see stats.php), so
+// showing them costs a single-row lookup per question.
 
 /**
  * Subclass for generating the bits of output specific to progcode questions.
@@ -190,7 +189,7 @@ abstract class qtype_progcode_renderer extends qtype_renderer {
         $i = 0;
 
         foreach ($testResults as $testResult) {
-            $testCase = $testCases[$testCaseKeys[$i]];
+            $testCase = $testCases[$testCaseKeys[$this->test_index($testResult, $i)]];
             if ($this->shouldDisplayResult($testCase, $testResult)) {
                 $tableRow = array();
                 $result = $testResult->output;
@@ -356,6 +355,14 @@ abstract class qtype_progcode_renderer extends qtype_renderer {
         return str_replace("\n", "<br />", str_replace(' ', '&nbsp;', $s));
     }
 
+    // The position of the testcase of the given test result, which is the
+    // ith, allowing for results that cover only some of the testcases
+    // (see grade_response in question.php).
+    private function test_index($testResult, $i) {
+        return isset($testResult->testindex) ? $testResult->testindex : $i;
+    }
+
+
     // Count the number of errors in the given array of test results.
     private function count_errors($testResults) {
         $errors = 0;
@@ -376,7 +383,7 @@ abstract class qtype_progcode_renderer extends qtype_renderer {
         $count = 0;
         $hidingRest = FALSE;
         foreach ($testResults as $tr) {
-            $testCase = $testCases[$testCaseKeys[$i]];
+            $testCase = $testCases[$testCaseKeys[$this->test_index($tr, $i)]];
             if ($hidingRest) {
                 $isDisplayed = FALSE;
             }
@@ -0,0 +1,328 @@
+<?php
+
+// This file is part of Moodle - http://moodle.org/
+//
+// Moodle is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+//
+// Moodle is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with Moodle.  If not, see <http://www.gnu.org/licenses/>.
+
+/**
+ * Incrementally maintained statistics for progcode questions.
+ *
+ * Each subclass (pycode, ccode etc) has two tables:
+ *   question_<qtype>_stats: one summary row per question, with counts of the
+ *       users attempting it, those succeeding, their submissions, their
+ *       ratings, the submission outcomes and the total grading time;
+ *   question_<qtype>_stat_users: one row per question and user, recording
+ *       that user's submissions, success and rating, so that the summary
+ *       can be updated correctly as each grading completes.
+ * Every update is a single-row insert or an atomic increment, and reading
+ * a question's statistics is a single-row lookup, so unlike the original
+ * scan over question_attempt_steps this scales with the number of
+ * submissions. backfill() rebuilds both tables from the attempt history
+ * (see cli/backfill_stats.php).
+ *
+ * Gradings are recorded inside the attempt's transaction, where a failed
+ * insert would abort the whole transaction on some databases (e.g.
+ * PostgreSQL), so no insert made there may fail. The summary row is
+ * therefore created when the question is saved (see create_summary), not
+ * when it's graded, and gradings of questions without one aren't recorded.
+ * The per-user rows have no unique index: two concurrent first gradings
+ * by the same user may each insert one, in which case the earlier row is
+ * used and the user's attempt is counted twice until the next backfill.
+ *
+ * The runs and failures of each test are also counted, in the runs and
+ * failures fields of the question_<qtype>_testcases table, so that the tests
+ * likeliest to fail can be run first when only a verdict is needed. These
+ * are counted whether or not COMPUTE_STATS is set.
+ *
+ * @package     qtype
+ * @subpackage  progcode
+ * @copyright   &copy; 2012 Richard Lobb
+ * @license     http://www.gnu.org/copyleft/gpl.html GNU GPL v3 or later
+ */
+
+defined('MOODLE_INTERNAL') || die();
+
+class qtype_progcode_stats {
+
+    // The summary columns counting each kind of submission outcome, keyed
+    // by the outcome of the first failing test ('Yes' if none failed).
+    public static $outcomecolumns = array(
+        'Yes' => 'correct',
+        'No' => 'wrong',
+        'Syntax Error' => 'syntaxerrors',
+        'Runtime Error' => 'runtimeerrors');
+    const OTHER_OUTCOMES = 'othererrors';
+
+    // The summary columns counting the ratings 1, 2 and 3.
+    public static $ratingcolumns = array(1 => 'likes', 2 => 'neutrals', 3 => 'dislikes');
+
+
+    // Return the name of the column counting submissions with the given
+    // list of test results.
+    public static function outcome_column($testresults) {
+        foreach ($testresults as $tr) {
+            if (!$tr->isCorrect) {
+                $outcome = isset($tr->outcome) ? $tr->outcome : 'No';
+                return isset(self::$outcomecolumns[$outcome]) ?
+                        self::$outcomecolumns[$outcome] : self::OTHER_OUTCOMES;
+            }
+        }
+        return self::$outcomecolumns['Yes'];
+    }
+
+
+    // Record a grading of a submission to the given question by the given
+    // user, taking $gradingtime seconds and giving the given test results.
+    // $rating is the user's current rating of the question (0 if none).
+    public static function record_grading($qtype, $questionid, $userid,
+            $testresults, $rating, $gradingtime) {
+        global $DB;
+        $statstable = "question_{$qtype}_stats";
+        $userstable = "question_{$qtype}_stat_users";
+        $succeeded = self::outcome_column($testresults) == self::$outcomecolumns['Yes'];
+
+        if (!$DB->record_exists($statstable, array('questionid' => $questionid))) {
+            return;  // Statistics aren't kept for this question
+        }
+        $increments = array('submissions', self::outcome_column($testresults));
+        $users = $DB->get_records($userstable,
+                array('questionid' => $questionid, 'userid' => $userid), 'id ASC', '*', 0, 1);
+        $user = reset($users);
+        if (!$user) {
+            $user = (object) array('questionid' => $questionid, 'userid' => $userid,
+                    'submissions' => 0, 'succeeded' => 0, 'rating' => 0);
+            $user->id = $DB->insert_record($userstable, $user);
+            $increments[] = 'attempts';
+        }
+        $sets = array('submissions = submissions + 1');
+        if ($succeeded && !$user->succeeded) {
+            $sets[] = 'succeeded = 1';
+            $increments[] = 'successes';
+        }
+        $decrements = array();
+        if ($rating != $user->rating) {
+            $sets[] = 'rating = ' . intval($rating);
+            if (isset(self::$ratingcolumns[$user->rating])) {
+                $decrements[] = self::$ratingcolumns[$user->rating];
+            }
+            if (isset(self::$ratingcolumns[$rating])) {
+                $increments[] = self::$ratingcolumns[$rating];
+            }
+        }
+        $DB->execute("UPDATE {{$userstable}} SET " . implode(', ', $sets) .
+                " WHERE id = ?", array($user->id));
+
+        $sets = array("gradingtime = gradingtime + ?");
+        foreach ($increments as $column) {
+            $sets[] = "$column = $column + 1";
+        }
+        foreach ($decrements as $column) {
+            $sets[] = "$column = $column - 1";
+        }
+        $DB->execute("UPDATE {{$statstable}} SET " . implode(', ', $sets) .
+                " WHERE questionid = ?", array($gradingtime, $questionid));
+    }
+
+
+    // Count a run of each of the testcases with the given test results, as
+    // a failure if it failed. $testcases is the array of the question's
+    // testcases, indexed by position; each result's testindex is the
+    // position of its testcase.
+    public static function record_test_outcomes($qtype, $testcases, $testresults) {
+        global $DB;
+        $ran = array();
+        $failed = array();
+        foreach ($testresults as $i => $tr) {
+            $index = isset($tr->testindex) ? $tr->testindex : $i;
+            if (isset($testcases[$index]->id)) {
+                $ran[] = $testcases[$index]->id;
+                if (!$tr->isCorrect) {
+                    $failed[] = $testcases[$index]->id;
+                }
+            }
+        }
+        if (count($ran) == 0) {
+            return;
+        }
+        list($ransql, $params) = $DB->get_in_or_equal($ran);
+        $sets = 'runs = runs + 1';
+        if (count($failed) > 0) {
+            list($failedsql, $failedparams) = $DB->get_in_or_equal($failed);
+            $sets .= ", failures = failures + CASE WHEN id $failedsql THEN 1 ELSE 0 END";
+            $params = array_merge($failedparams, $params);
+        }
+        $DB->execute("UPDATE {question_{$qtype}_testcases} SET $sets WHERE id $ransql", $params);
+    }
+
+
+    // Make sure the given question has a summary row, so that its
+    // gradings are recorded. Call only outside grading, e.g. when the
+    // question is saved.
+    public static function create_summary($qtype, $questionid) {
+        global $DB;
+        $statstable = "question_{$qtype}_stats";
+        if (!$DB->record_exists($statstable, array('questionid' => $questionid))) {
+            $DB->insert_record($statstable, self::empty_summary($questionid));
+        }
+    }
+
+
+    private static function empty_summary($questionid) {
+        $summary = array('questionid' => $questionid, 'attempts' => 0,
+                'successes' => 0, 'submissions' => 0, 'gradingtime' => 0.0,
+                self::OTHER_OUTCOMES => 0);
+        foreach (array_merge(self::$outcomecolumns, self::$ratingcolumns) as $column) {
+            $summary[$column] = 0;
+        }
+        return (object) $summary;
+    }
+
+
+    // Return the statistics of the given question, as an object with
+    // fields question_id, attempts, success_percent, average_retries
+    // (submissions per attempt), likes, neutrals, dislikes, submissions,
+    // average_grading_time (seconds) and outcomes (an array mapping each
+    // outcome column name to its count).
+    public static function get($qtype, $questionid) {
+        global $DB;
+        $summary = $DB->get_record("question_{$qtype}_stats", array('questionid' => $questionid));
+        if (!$summary) {
+            $summary = self::empty_summary($questionid);
+        }
+        $attempts = $summary->attempts;
+        $outcomes = array();
+        foreach (array_merge(array_values(self::$outcomecolumns), array(self::OTHER_OUTCOMES)) as $column) {
+            $outcomes[$column] = $summary->$column;
+        }
+        return (object) array(
+            'question_id' => $questionid,
+            'attempts'    => $attempts,
+            'success_percent' => $attempts == 0 ? 0 : intval(100.0 * $summary->successes / $attempts),
+            'average_retries' => $attempts == 0 ? 0 : $summary->submissions / $attempts,
+            'likes'    => $summary->likes,
+            'neutrals' => $summary->neutrals,
+            'dislikes' => $summary->dislikes,
+            'submissions' => $summary->submissions,
+            'average_grading_time' => $summary->submissions == 0 ? 0 :
+                    $summary->gradingtime / $summary->submissions,
+            'outcomes' => $outcomes);
+    }
+
+
+    // Delete the statistics of the given question.
+    public static function delete($qtype, $questionid) {
+        global $DB;
+        $DB->delete_records("question_{$qtype}_stat_users", array('questionid' => $questionid));
+        $DB->delete_records("question_{$qtype}_stats", array('questionid' => $questionid));
+    }
+
+
+    // Rebuild the statistics of all questions of the given type, with a
+    // summary row for each, from the graded steps of their attempts, streaming through them rather than
+    // using the correlated subqueries of the original statistics code.
+    // Grading times aren't recorded in the attempt history, so are zeroed.
+    // Outcomes are taken from each graded step's cached test results.
+    // Returns the number of questions with statistics.
+    public static function backfill($qtype) {
+        global $DB;
+        $statstable = "question_{$qtype}_stats";
+        $userstable = "question_{$qtype}_stat_users";
+        $summaries = array();
+        $users = array();
+
+        // Every question gets a summary row, so its gradings are recorded
+        $questionids = $DB->get_fieldset_select('question', 'id', 'qtype = ?', array($qtype));
+        foreach ($questionids as $questionid) {
+            $summaries[$questionid] = self::empty_summary($questionid);
+        }
+
+        // One row per graded step, in step order within each attempt
+        $steps = $DB->get_recordset_sql("
+            SELECT qas.id, qa.questionid, qas.userid, qas.fraction, qasd.value AS testresults
+            FROM {question} q
+            JOIN {question_attempts} qa ON qa.questionid = q.id
+            JOIN {question_attempt_steps} qas ON qas.questionattemptid = qa.id
+            LEFT JOIN {question_attempt_step_data} qasd
+                ON qasd.attemptstepid = qas.id AND qasd.name = '_testresults'
+            WHERE q.qtype = ? AND qas.fraction IS NOT NULL AND qas.sequencenumber > 0
+            ORDER BY qas.id", array($qtype));
+        foreach ($steps as $step) {
+            $questionid = $step->questionid;
+            if (!isset($summaries[$questionid])) {
+                $summaries[$questionid] = self::empty_summary($questionid);
+            }
+            $summary = $summaries[$questionid];
+            $key = "$questionid/{$step->userid}";
+            if (!isset($users[$key])) {
+                $users[$key] = (object) array('questionid' => $questionid,
+                        'userid' => $step->userid, 'submissions' => 0,
+                        'succeeded' => 0, 'rating' => 0);
+                $summary->attempts++;
+            }
+            $user = $users[$key];
+            $user->submissions++;
+            $summary->submissions++;
+            if ($step->fraction > 0.0 && !$user->succeeded) {
+                $user->succeeded = 1;
+                $summary->successes++;
+            }
+            $testresults = $step->testresults ? @unserialize($step->testresults) : false;
+            if (is_array($testresults)) {
+                $column = self::outcome_column($testresults);
+            }
+            else {
+                $column = $step->fraction > 0.0 ? 'correct' : 'wrong';
+            }
+            $summary->$column++;
+        }
+        $steps->close();
+
+        // The latest rating of each user
+        $ratings = $DB->get_recordset_sql("
+            SELECT qasd.id, qa.questionid, qas.userid, qasd.value AS rating
+            FROM {question} q
+            JOIN {question_attempts} qa ON qa.questionid = q.id
+            JOIN {question_attempt_steps} qas ON qas.questionattemptid = qa.id
+            JOIN {question_attempt_step_data} qasd ON qasd.attemptstepid = qas.id
+            WHERE q.qtype = ? AND qasd.name = 'rating'
+            ORDER BY qasd.id", array($qtype));
+        foreach ($ratings as $rating) {
+            $key = "{$rating->questionid}/{$rating->userid}";
+            if (isset($users[$key])) {
+                $users[$key]->rating = intval($rating->rating);
+            }
+        }
+        $ratings->close();
+        foreach ($users as $user) {
+            if (isset(self::$ratingcolumns[$user->rating])) {
+                $column = self::$ratingcolumns[$user->rating];
+                $summaries[$user->questionid]->$column++;
+            }
+        }
+
+        $transaction = $DB->start_delegated_transaction();
+        $DB->delete_records_select($userstable,
+                "questionid IN (SELECT id FROM {question} WHERE qtype = ?)", array($qtype));
+        $DB->delete_records_select($statstable,
+                "questionid IN (SELECT id FROM {question} WHERE qtype = ?)", array($qtype));
+        foreach ($summaries as $summary) {
+            $DB->insert_record($statstable, $summary, false);
+        }
+        foreach ($users as $user) {
+            $DB->insert_record($userstable, $user, false);
+        }
+        $transaction->allow_commit();
+        return count($summaries);
+    }
+}
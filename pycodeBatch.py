@@ -0,0 +1,168 @@
+# Batch grading: run many pycode submissions in a single invocation.
+#
+# Jobs are read from stdin, one JSON object per line, of the form
+#     {"id": <submission id>, "code": <student code>, "tests": <testlist>}
+# where testlist is as for PycodeTester.runTests. For each job one JSON
+# line is written to stdout as soon as the job completes, of the form
+#     {"id": <submission id>, "results": [[outcome, output], ...]}
+# or, if the job line couldn't be processed or grading failed,
+#     {"id": <submission id or null>, "error": <message>}
+# Outputs that aren't valid UTF-8 are decoded as Latin-1.
+# With more than one process, results are written in completion order,
+# not input order.
+# With --metrics, each reply also has a "metrics" object with keys
+# "submission" and "tests" (see PycodeTester.summariseMetrics and runTest)
+# and a summary of the metrics of all jobs, grouped by the optional
+# "question" field of each job, is written to stderr as JSON at the end.
+# The metrics include the lines of student code executed only with
+# --count-lines, which slows grading down.
+#
+# With --cache-dir, results are cached in the given directory (see
+# pycodeCache.py), so resubmissions already graded, in this batch or an
+# earlier one, aren't run again.
+#
+# With --stop-on-mismatch, each test stops as soon as its output can't
+# match, with --run-all testing carries on after errors other than syntax
+# errors and with --fail-fast it stops at the first failing test (see
+# PycodeTester). --cpu-limit, --wall-limit and --mem-limit limit each test,
+# so that one submission that never stops can't hold up the batch.
+#
+# Usage: python pycodeBatch.py [--processes N] [--compile-once] [--metrics]
+#                              [--count-lines] [--stop-on-mismatch] [--run-all] [--fail-fast]
+#                              [--cpu-limit SECS] [--wall-limit SECS] [--mem-limit MB]
+#                              [--cache-dir DIR]
+#                              < jobs.jsonl
+
+import argparse
+import json
+import multiprocessing
+import sys
+
+from pycodeCache import PycodeResultCache
+from pycodeClasses import PycodeTester
+from pycodeMetrics import PycodeMetricsAggregator
+
+
+def jsonText(output):
+    '''Return output as unicode for JSON: decoded as UTF-8 if valid, else
+       as Latin-1, which maps each byte to one character'''
+    if isinstance(output, unicode):
+        return output
+    try:
+        return output.decode('utf-8')
+    except UnicodeDecodeError:
+        return output.decode('latin-1')
+
+
+# The result cache of this process for each cache directory (see resultCache)
+resultCaches = {}
+
+def resultCache(directory):
+    '''Return this process's cache of results in the given directory, or
+       None if directory is None. Each grading process makes its own.'''
+    if directory is None:
+        return None
+    if directory not in resultCaches:
+        resultCaches[directory] = PycodeResultCache(directory=directory)
+    return resultCaches[directory]
+
+
+def gradeJob(jobArgs):
+    '''Grade a single job line, returning the reply object'''
+    (line, testerOptions, cacheDir) = jobArgs
+    jobId = None
+    try:
+        job = json.loads(line)
+        jobId = job.get('id')
+        tester = PycodeTester(job['code'], cache=resultCache(cacheDir), **testerOptions)
+        results = tester.runTests(job['tests'])
+        reply = {'id': jobId,
+                 'results': [(outcome, jsonText(output)) for (outcome, output) in results]}
+        if tester.collectMetrics:
+            reply['metrics'] = {'submission': tester.submissionMetrics,
+                                'tests': [details['metrics'] for details in tester.testDetails]}
+            reply['question'] = job.get('question')
+        return reply
+    except (ValueError, KeyError, TypeError, AttributeError), e:
+        return {'id': jobId, 'error': 'Bad job: {0}'.format(e)}
+    except BaseException, e:   # Anything escaping the tester would end the batch or hang the pool
+        return {'id': jobId, 'error': 'Grading failed: {0!r}'.format(e)}
+
+
+def readJobs(infile, testerOptions, cacheDir):
+    '''Generate the non-blank job lines from infile, each with the
+       dictionary of PycodeTester options to grade it with and the
+       cache directory'''
+    for line in iter(infile.readline, ''):   # Not 'for line in infile', which reads ahead
+        if line.strip():
+            yield (line, testerOptions, cacheDir)
+
+
+def runBatch(infile, outfile, processes=1, compileOnce=False, aggregator=None,
+             stopOnMismatch=False, runAll=False, failFast=False, countLines=False,
+             cpuLimit=None, wallLimit=None, memLimit=None, cacheDir=None):
+    '''Grade all jobs from infile, writing replies to outfile. If
+       aggregator is not None, metrics are collected and added to it,
+       including lines executed if countLines is True. cpuLimit,
+       wallLimit and memLimit, if not None, limit each test (see
+       PycodeTester). If cacheDir is not None, results are cached
+       there.'''
+    testerOptions = {'compileOnce': compileOnce, 'metrics': aggregator is not None,
+                     'countLines': countLines, 'stopOnMismatch': stopOnMismatch,
+                     'runAll': runAll, 'failFast': failFast, 'cpuLimit': cpuLimit,
+                     'wallLimit': wallLimit, 'memLimit': memLimit}
+    jobs = readJobs(infile, testerOptions, cacheDir)
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        replies = pool.imap_unordered(gradeJob, jobs)
+    else:
+        pool = None
+        replies = (gradeJob(job) for job in jobs)
+    try:
+        for reply in replies:
+            if aggregator is not None and 'metrics' in reply:
+                aggregator.add(reply['metrics']['submission'], reply.pop('question'))
+            outfile.write(json.dumps(reply) + '\n')
+            outfile.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Grade a stream of pycode jobs')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of grading processes (default 1)')
+    parser.add_argument('--compile-once', action='store_true',
+                        help='run each submission from a snapshot (see PycodeSnapshot)')
+    parser.add_argument('--metrics', action='store_true',
+                        help='report metrics per job and a summary on stderr')
+    parser.add_argument('--count-lines', action='store_true',
+                        help='include lines executed in the metrics (slow)')
+    parser.add_argument('--stop-on-mismatch', action='store_true',
+                        help='stop each test as soon as its output is wrong')
+    parser.add_argument('--run-all', action='store_true',
+                        help='carry on testing after errors other than syntax errors')
+    parser.add_argument('--fail-fast', action='store_true',
+                        help='stop testing at the first failing test')
+    parser.add_argument('--cpu-limit', type=float, default=None,
+                        help='per-test CPU limit in seconds')
+    parser.add_argument('--wall-limit', type=float, default=None,
+                        help='per-test elapsed time limit in seconds')
+    parser.add_argument('--mem-limit', type=int, default=None,
+                        help='per-test memory limit in MB')
+    parser.add_argument('--cache-dir', metavar='DIR', default=None,
+                        help='cache results in DIR (see pycodeCache.py)')
+    args = parser.parse_args()
+    aggregator = PycodeMetricsAggregator() if args.metrics else None
+    memLimit = args.mem_limit * 2**20 if args.mem_limit is not None else None
+    runBatch(sys.stdin, sys.stdout, args.processes, args.compile_once, aggregator,
+             args.stop_on_mismatch, args.run_all, args.fail_fast, args.count_lines,
+             args.cpu_limit, args.wall_limit, memLimit, args.cache_dir)
+    if aggregator is not None:
+        sys.stderr.write(json.dumps(aggregator.summary()) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+# Grading benchmark for PycodeTester.
+#
+# Grades a corpus of representative submissions (modelled on the cases in
+# sandboxTests.py and the testSandbox*.py scripts) repeatedly and reports,
+# for each kind of submission and overall, throughput in submissions per
+# second and p50/p95/p99 grading latency, plus the peak RSS of the process.
+# Results can be saved as JSON and compared with those of another revision.
+#
+# Usage:
+#     python pycodeBenchmark.py [--repeat N] [--compile-once] [--cpu-limit S]
+#                               [--save FILE] [--compare FILE] [--label LABEL]
+#
+# E.g. to compare the working tree with the last commit:
+#     git stash; python pycodeBenchmark.py --save base.json; git stash pop
+#     python pycodeBenchmark.py --compare base.json
+
+import argparse
+import json
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from pycodeClasses import PycodeTester
+
+
+def buildCorpus():
+    '''Return a list of (name, code, tests) triples'''
+    corpus = []
+
+    corpus.append(('function', '''def hello(name):
+  return "Hello " + name
+''', [("hello('')", "", "'Hello '"),
+      ("hello('Richard')", "", "'Hello Richard'"),
+      ("name = 'Richard'\nname\nprint name\nhello(name)", "", "'Richard'\nRichard\n'Hello Richard'")]))
+
+    corpus.append(('print-heavy', '''def table(n):
+  for i in range(n):
+    print i, i * i
+''', [("table(5000)", "", '\n'.join('{0} {1}'.format(i, i * i) for i in range(5000))),
+      ("table(20000)", "", '\n'.join('{0} {1}'.format(i, i * i) for i in range(20000)))]))
+
+    corpus.append(('file-io', '''def makeInput(filename, n):
+  f = open(filename, 'w')
+  for i in range(n):
+    f.write('line %d\\n' % i)
+  f.close()
+
+def copyUpper(src, dest):
+  out = open(dest, 'w')
+  for line in open(src):
+    out.write(line.upper())
+  out.close()
+''', [("makeInput('in.txt', 20000)\ncopyUpper('in.txt', 'out.txt')\n"
+       "print len(open('out.txt').readlines())", "", "20000")]))
+
+    lines = '\n'.join(str(i) for i in range(5000))
+    corpus.append(('raw_input-heavy', '''total = 0
+try:
+  while True:
+    total += int(raw_input())
+except EOFError:
+  print total
+''', [("", lines, str(sum(range(5000)))),
+      ("", "1\n2\n3\n", "6")]))
+
+    corpus.append(('long-loop', '''def count(n):
+  t = 0
+  while n > 0:
+    t += n % 7
+    n -= 1
+  return t
+''', [("print count(300000)", "", str(sum(n % 7 for n in range(1, 300001))))]))
+
+    corpus.append(('syntax-error', '''def hello(name)
+  return "Hello " + name
+''', [("hello('')", "", "'Hello '"),
+      ("hello('Richard')", "", "'Hello Richard'")]))
+
+    corpus.append(('runtime-error', '''def hello(name):
+  if name != 'Richard Lobb':
+      return "Hello " + name
+  else:
+      return namex
+''', [("hello('')", "", "'Hello '"),
+      ("hello('Richard Lobb')", "", "'Hello Richard Lobb'")]))
+
+    return corpus
+
+
+def percentile(sortedValues, p):
+    '''Return the p-th percentile of a non-empty sorted list'''
+    index = int(round(p / 100.0 * (len(sortedValues) - 1)))
+    return sortedValues[index]
+
+
+def summarise(latencies):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {'submissions': len(latencies),
+            'throughput': len(latencies) / total if total > 0 else 0.0,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99)}
+
+
+def runBenchmark(repeat, testerOptions):
+    '''Grade each corpus entry repeat times, returning a dictionary of
+       summaries by corpus name and overall, and the peak RSS in kB'''
+    latencies = {}
+    allLatencies = []
+    for i in range(repeat):
+        for (name, code, tests) in buildCorpus():
+            startTime = time.time()
+            PycodeTester(code, **testerOptions).runTests(tests)
+            elapsed = time.time() - startTime
+            latencies.setdefault(name, []).append(elapsed)
+            allLatencies.append(elapsed)
+    results = {'cases': dict((name, summarise(values)) for (name, values) in latencies.items()),
+               'overall': summarise(allLatencies)}
+    if resource is not None:
+        results['peakRssKb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def printResults(results, baseline=None):
+    print '{0:18s} {1:>10s} {2:>10s} {3:>10s} {4:>10s}'.format(
+        'case', 'subs/sec', 'p50 ms', 'p95 ms', 'p99 ms')
+    rows = sorted(results['cases'].items()) + [('OVERALL', results['overall'])]
+    for (name, summary) in rows:
+        print '{0:18s} {1:10.1f} {2:10.2f} {3:10.2f} {4:10.2f}'.format(
+            name, summary['throughput'], 1000 * summary['p50'],
+            1000 * summary['p95'], 1000 * summary['p99'])
+        if baseline is not None:
+            if name == 'OVERALL':
+                old = baseline['overall']
+            else:
+                old = baseline['cases'].get(name)
+            if old is not None:
+                print '{0:18s} {1:>10s} {2:>10s} {3:>10s} {4:>10s}'.format(
+                    '  vs ' + baseline.get('label', 'baseline'),
+                    change(summary['throughput'], old['throughput']),
+                    change(summary['p50'], old['p50']),
+                    change(summary['p95'], old['p95']),
+                    change(summary['p99'], old['p99']))
+    if 'peakRssKb' in results:
+        print 'Peak RSS: {0} kB'.format(results['peakRssKb'])
+
+
+def change(new, old):
+    '''Format the relative change from old to new as a percentage'''
+    if old == 0:
+        return 'n/a'
+    return '{0:+.1f}%'.format(100.0 * (new - old) / old)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark PycodeTester grading')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='number of times to grade each submission (default 20)')
+    parser.add_argument('--compile-once', action='store_true',
+                        help='run tests from a snapshot (see PycodeSnapshot)')
+    parser.add_argument('--cpu-limit', type=float, default=None,
+                        help='per-test CPU limit in seconds')
+    parser.add_argument('--save', metavar='FILE', help='save results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with saved results')
+    parser.add_argument('--label', default=None, help='label for saved results, e.g. a revision')
+    args = parser.parse_args()
+
+    # Pass only the options given, so the benchmark runs against older
+    # revisions of PycodeTester that lack them
+    testerOptions = {}
+    if args.compile_once:
+        testerOptions['compileOnce'] = True
+    if args.cpu_limit is not None:
+        testerOptions['cpuLimit'] = args.cpu_limit
+    results = runBenchmark(args.repeat, testerOptions)
+    results['label'] = args.label or time.strftime('%Y-%m-%d %H:%M:%S')
+    results['options'] = testerOptions
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    printResults(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
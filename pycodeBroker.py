@@ -0,0 +1,433 @@
+# Distributed grading: grading requests are published to a broker and
+# graded by grader nodes, which may run on any number of hosts, so that
+# grading capacity can be scaled independently of the Moodle web servers.
+#
+# A job is a request as for PycodeWorkerPool.runTests (code, testlist and a
+# dictionary of PycodeTester options) with an id and a priority class (see
+# pycodeServer.py). The publisher of a job waits for its result by id. Each
+# grader node claims jobs from the broker, highest priority class first,
+# grades them with its own PycodeWorkerPool and posts the results back. Nodes
+# report their capacity and load to the broker with a periodic heartbeat;
+# the jobs of a node that stops beating are assumed lost and are requeued,
+# up to maxRetries times, after which they fail with WORKER_FAILED. A node
+# lost for over NODE_FORGET seconds is forgotten. A publisher that gives up
+# waiting cancels its job, and results nobody collects are removed after
+# RESULT_LIFETIME seconds.
+#
+# Brokers are pluggable: PycodeBroker defines the interface and
+# PycodeFileBroker implements it with a directory of files, using atomic
+# renames to hand each job to a single node. It needs nothing but a
+# directory shared by all hosts (a local one for testing, or e.g. NFS).
+#
+# To grade via a broker from Moodle, run the grading server (see
+# pycodeServer.py) with --broker on each web node; its queues and priority
+# classes are unchanged but its jobs are graded by the grader nodes.
+#
+# Usage:
+#     python pycodeBroker.py node --broker DIR [--workers N] [--node-id ID]
+#                                 [--pool-command COMMAND]
+#     python pycodeBroker.py status --broker DIR
+#
+# Clients can use gradeViaBroker, e.g.
+#     results = gradeViaBroker(PycodeFileBroker('/srv/pycode-broker'), code, tests)
+
+import argparse
+import base64
+import errno
+import json
+import multiprocessing
+import os
+import shlex
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from pycodePool import PycodeWorkerPool, WORKER_FAILED, encodeOutput, jobTimeout
+from pycodeProtocol import PRIORITY_CLASSES
+
+HEARTBEAT_INTERVAL = 2.0   # Seconds between a node's heartbeats
+NODE_TIMEOUT = 10.0        # Seconds without a heartbeat before a node is lost
+NODE_FORGET = 60.0         # Seconds without a heartbeat before a node is forgotten
+RESULT_LIFETIME = 600.0    # Seconds before uncollected results are removed
+POLL_INTERVAL = 0.05       # Seconds between polls for jobs or results
+
+
+class BrokerTimeout (Exception):
+    '''Raised when a job's result doesn't arrive in time'''
+    pass
+
+
+
+class PycodeBroker (object):
+    '''The interface of a broker. Jobs are dictionaries with keys 'id',
+       'code', 'tests', 'options', 'priority' and 'attempts' (the number
+       of times the job has been claimed by a node that was then lost).'''
+
+    def publish(self, code, tests, options=None, priority='interactive'):
+        '''Queue a new job, returning its id'''
+        raise NotImplementedError()
+
+
+    def claim(self, nodeId):
+        '''Take the next job for the given node to grade, or None if there
+           are none waiting'''
+        raise NotImplementedError()
+
+
+    def complete(self, nodeId, job, results):
+        '''Post the results of a job claimed by the given node'''
+        raise NotImplementedError()
+
+
+    def result(self, jobId):
+        '''Remove and return the results of the given job, or None if
+           they haven't been posted yet'''
+        raise NotImplementedError()
+
+
+    def cancel(self, jobId):
+        '''Withdraw the given job, whose results are no longer wanted'''
+        raise NotImplementedError()
+
+
+    def heartbeat(self, nodeId, capacity, running, graded):
+        '''Report that the given node is alive with capacity workers, of
+           which running are busy, and has graded graded jobs'''
+        raise NotImplementedError()
+
+
+    def nodes(self):
+        '''Return a list of the latest report of each node, as dictionaries
+           with keys 'node', 'capacity', 'running', 'graded', 'heartbeat'
+           (time of the report) and 'alive' '''
+        raise NotImplementedError()
+
+
+    def recoverLost(self):
+        '''Requeue the jobs claimed by lost nodes, failing those that have
+           been retried too often, and forget long-lost nodes and stale
+           results. Returns the number of jobs recovered.'''
+        raise NotImplementedError()
+
+
+
+class PycodeFileBroker (PycodeBroker):
+    '''A broker using a directory of files, with subdirectories
+         pending: jobs waiting, named so they sort in the order to be taken;
+         claimed/<node>: jobs being graded by each node;
+         results: results waiting to be collected, named by job id, with
+                  outputs base64-encoded as they needn't be valid UTF-8;
+         nodes: the latest heartbeat of each node;
+         tmp: files being written, which are renamed into place when
+              complete so that no reader sees a partial file.'''
+
+    def __init__(self, directory, nodeTimeout=NODE_TIMEOUT, maxRetries=2,
+                 nodeForget=NODE_FORGET, resultLifetime=RESULT_LIFETIME):
+        self.directory = directory
+        self.nodeTimeout = nodeTimeout
+        self.maxRetries = maxRetries
+        self.nodeForget = nodeForget
+        self.resultLifetime = resultLifetime
+        for subdir in ('pending', 'claimed', 'results', 'nodes', 'tmp'):
+            makeDirs(self.path(subdir))
+
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+
+    def writeFile(self, path, data):
+        '''Atomically create (or replace) the file path with JSON data'''
+        tmpPath = self.path('tmp', uuid.uuid4().hex)
+        with open(tmpPath, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmpPath, path)
+
+
+    def readFile(self, path):
+        with open(path) as f:
+            return json.load(f)
+
+
+    def pendingName(self, job):
+        '''The name of a pending job's file: priority class, then time of
+           (re)queueing, so that names sort in the order jobs are taken'''
+        return '{0}-{1:017.6f}-{2}.json'.format(PRIORITY_CLASSES.index(job['priority']),
+                                               time.time(), job['id'])
+
+
+    def publish(self, code, tests, options=None, priority='interactive'):
+        job = {'id': uuid.uuid4().hex, 'code': code, 'tests': tests,
+               'options': options or {}, 'priority': priority, 'attempts': 0}
+        self.writeFile(self.path('pending', self.pendingName(job)), job)
+        return job['id']
+
+
+    def claim(self, nodeId):
+        claimedDir = self.path('claimed', nodeId)
+        makeDirs(claimedDir)
+        for name in sorted(os.listdir(self.path('pending'))):
+            try:
+                os.rename(self.path('pending', name), os.path.join(claimedDir, name))
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    continue   # Claimed by another node
+                raise
+            job = self.readFile(os.path.join(claimedDir, name))
+            job['claimName'] = name
+            return job
+        return None
+
+
+    def writeResults(self, jobId, results):
+        self.writeFile(self.path('results', jobId + '.json'),
+                       [(outcome, encodeOutput(output)) for (outcome, output) in results])
+
+
+    def complete(self, nodeId, job, results):
+        self.writeResults(job['id'], results)
+        removeFile(self.path('claimed', nodeId, job['claimName']))
+
+
+    def result(self, jobId):
+        path = self.path('results', jobId + '.json')
+        try:
+            results = self.readFile(path)
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        removeFile(path)
+        return [(str(outcome), base64.b64decode(output)) for (outcome, output) in results]
+
+
+    def cancel(self, jobId):
+        for name in os.listdir(self.path('pending')):
+            if name.endswith('-{0}.json'.format(jobId)):
+                removeFile(self.path('pending', name))
+        removeFile(self.path('results', jobId + '.json'))
+        # If a node is grading it, its results are removed once stale
+
+
+    def heartbeat(self, nodeId, capacity, running, graded):
+        self.writeFile(self.path('nodes', nodeId + '.json'),
+                       {'node': nodeId, 'capacity': capacity, 'running': running,
+                        'graded': graded, 'heartbeat': time.time()})
+
+
+    def nodes(self):
+        reports = []
+        for name in sorted(os.listdir(self.path('nodes'))):
+            try:
+                report = self.readFile(self.path('nodes', name))
+            except (IOError, ValueError):
+                continue   # Removed since listed
+            report['alive'] = time.time() - report['heartbeat'] < self.nodeTimeout
+            reports.append(report)
+        return reports
+
+
+    def recoverLost(self):
+        reports = self.nodes()
+        alive = set(report['node'] for report in reports if report['alive'])
+        recovered = 0
+        for nodeId in os.listdir(self.path('claimed')):
+            if nodeId in alive:
+                continue
+            claimedDir = self.path('claimed', nodeId)
+            for name in os.listdir(claimedDir):
+                # Move the job aside first so only one recoverer handles it
+                tmpPath = self.path('tmp', uuid.uuid4().hex)
+                try:
+                    os.rename(os.path.join(claimedDir, name), tmpPath)
+                except OSError:
+                    continue   # Completed or recovered meanwhile
+                job = self.readFile(tmpPath)
+                job['attempts'] += 1
+                if job['attempts'] > self.maxRetries:
+                    self.writeResults(job['id'], [WORKER_FAILED])
+                else:
+                    self.writeFile(self.path('pending', self.pendingName(job)), job)
+                removeFile(tmpPath)
+                recovered += 1
+            removeDir(claimedDir)
+        for report in reports:
+            if time.time() - report['heartbeat'] > self.nodeForget:
+                removeFile(self.path('nodes', report['node'] + '.json'))
+        for name in os.listdir(self.path('results')):
+            try:
+                if time.time() - os.path.getmtime(self.path('results', name)) > self.resultLifetime:
+                    removeFile(self.path('results', name))
+            except OSError:
+                continue   # Collected meanwhile
+        return recovered
+
+
+
+def makeDirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def removeFile(path):
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def removeDir(path):
+    '''Remove the directory path if it's empty'''
+    try:
+        os.rmdir(path)
+    except OSError, e:
+        if e.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+            raise
+
+
+
+class PycodeGraderNode (object):
+    '''A grader node: workers threads each claim jobs from the broker and
+       grade them with a worker of the node's PycodeWorkerPool, while
+       another thread sends heartbeats and recovers the jobs of lost
+       nodes.'''
+    def __init__(self, broker, nodeId=None, workers=None, poolCommand=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if nodeId is None:
+            nodeId = '{0}-{1}'.format(socket.gethostname(), os.getpid())
+        self.broker = broker
+        self.nodeId = nodeId
+        self.workers = workers
+        self.pool = PycodeWorkerPool(workers, command=poolCommand)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.graded = 0
+        self.stopping = threading.Event()
+        self.threads = []
+
+
+    def start(self):
+        '''Start grading, in background threads'''
+        self.beat()
+        targets = [self.grade] * self.workers + [self.monitor]
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+
+    def stop(self):
+        '''Stop claiming jobs and wait for those being graded to finish'''
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.beat()
+        self.pool.close()
+
+
+    def grade(self):
+        '''The main loop of a grading thread'''
+        while not self.stopping.is_set():
+            job = self.broker.claim(self.nodeId)
+            if job is None:
+                self.stopping.wait(POLL_INTERVAL)
+                continue
+            with self.lock:
+                self.running += 1
+            try:
+                results = self.pool.runTests(job['code'], job['tests'], job['options'],
+                                             jobTimeout(job['tests'], job['options']))
+            except Exception, e:
+                self.log('Grading failed: {0}'.format(e))
+                results = [WORKER_FAILED]
+            self.broker.complete(self.nodeId, job, results)
+            with self.lock:
+                self.running -= 1
+                self.graded += 1
+
+
+    def monitor(self):
+        '''The main loop of the heartbeat thread'''
+        while not self.stopping.wait(HEARTBEAT_INTERVAL):
+            self.beat()
+            try:
+                recovered = self.broker.recoverLost()
+            except (IOError, OSError, ValueError), e:
+                self.log('Recovering lost jobs failed: {0}'.format(e))
+                continue
+            if recovered:
+                self.log('Recovered {0} jobs from lost nodes'.format(recovered))
+
+
+    def beat(self):
+        with self.lock:
+            (running, graded) = (self.running, self.graded)
+        self.broker.heartbeat(self.nodeId, self.workers, running, graded)
+
+
+    def log(self, message):
+        print >> sys.stderr, '{0}: {1}'.format(self.nodeId, message)
+
+
+
+def gradeViaBroker(broker, code, tests, options=None, priority='interactive', timeout=None):
+    '''Publish the given code and tests to the broker and wait for the
+       results, a list of (outcome, output) pairs as for
+       PycodeTester.runTests. options is a dictionary of PycodeTester
+       options. Raises BrokerTimeout, having cancelled the job, if the
+       results don't arrive within timeout seconds (if not None).'''
+    jobId = broker.publish(code, tests, options, priority)
+    deadline = None if timeout is None else time.time() + timeout
+    results = broker.result(jobId)
+    while results is None:
+        if deadline is not None and time.time() > deadline:
+            broker.cancel(jobId)
+            raise BrokerTimeout('No result for job {0} after {1} seconds'.format(jobId, timeout))
+        time.sleep(POLL_INTERVAL)
+        results = broker.result(jobId)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run or inspect pycode grader nodes')
+    parser.add_argument('command', choices=['node', 'status'],
+                        help="'node' to run a grader node, 'status' to list nodes")
+    parser.add_argument('--broker', required=True, metavar='DIR',
+                        help='directory of the file broker')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of grading workers (default one per core)')
+    parser.add_argument('--node-id', default=None,
+                        help='name of this node (default host name and process id)')
+    parser.add_argument('--pool-command', metavar='COMMAND', default=None,
+                        help='command that starts a sandboxed grading worker '
+                             '(see pycodeServer.py)')
+    args = parser.parse_args()
+    broker = PycodeFileBroker(args.broker)
+    if args.command == 'status':
+        for report in broker.nodes():
+            print '{0:30s} {1:>6s} {2:3d}/{3:<3d} busy {4:8d} graded'.format(
+                report['node'], 'alive' if report['alive'] else 'LOST',
+                report['running'], report['capacity'], report['graded'])
+        return
+    poolCommand = shlex.split(args.pool_command) if args.pool_command else None
+    node = PycodeGraderNode(broker, args.node_id, args.workers, poolCommand)
+    node.start()
+    try:
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        node.stop()
+
+
+if __name__ == '__main__':
+    main()
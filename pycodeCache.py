@@ -0,0 +1,162 @@
+# A content-addressed cache of pycode test results, so that identical
+# submissions of the same question aren't re-executed.
+#
+# Results are keyed on a hash of the normalised student code, the test list
+# (testcode, stdin, expected), any tester options that affect the results and
+# the grader version. An in-memory LRU cache, bounded by number of entries
+# and total output size, optionally fronts an on-disk store (one file per
+# key) that survives restarts.
+#
+# Usage:
+#     cache = PycodeResultCache(directory='/var/cache/pycode')
+#     results = PycodeTester(code, cache=cache).runTests(tests)
+
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+GRADER_VERSION = '6'   # Change whenever grading behaviour changes
+
+
+def normaliseCode(code):
+    '''Return code with CRLFs replaced by newlines and trailing whitespace
+       removed, so trivially different resubmissions share a key'''
+    return code.replace('\r\n', '\n').rstrip() + '\n'
+
+
+def makeKey(code, tests, options=None):
+    '''Return the cache key for the given code, tests and tester options'''
+    normalisedTests = []
+    for test in tests:
+        if len(test) == 2:
+            (testInput, expected) = test
+            stdin = None
+        else:
+            (testInput, stdin, expected) = test
+        normalisedTests.append([testInput, stdin, expected])
+    spec = [GRADER_VERSION, normaliseCode(code), normalisedTests, options]
+    return hashlib.sha256(json.dumps(spec, sort_keys=True)).hexdigest()
+
+
+class PycodeResultCache (object):
+    def __init__(self, maxEntries=10000, maxBytes=None, directory=None,
+                 maxDiskEntries=None):
+        '''Construct a cache holding at most maxEntries results, with a total
+           output size of at most maxBytes (if not None), in memory. If
+           directory is not None, results are also stored in files there,
+           with the least recently used files removed when there are more
+           than maxDiskEntries (if not None).'''
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.directory = directory
+        self.maxDiskEntries = maxDiskEntries
+        self.entries = collections.OrderedDict()  # key -> (results, size)
+        self.bytesUsed = 0
+        self.putsSincePrune = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+
+    def key(self, code, tests, options=None):
+        '''The key under which results are cached; see makeKey'''
+        return makeKey(code, tests, options)
+
+
+    def get(self, key):
+        '''Return the list of (outcome, output) results for the given key,
+           or None if not cached'''
+        with self.lock:
+            if key in self.entries:
+                entry = self.entries.pop(key)
+                self.entries[key] = entry   # Now most recently used
+                self.hits += 1
+                return list(entry[0])
+        results = self.readFile(key)
+        with self.lock:
+            if results is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.remember(key, results)
+        return results
+
+
+    def put(self, key, results):
+        '''Cache the given list of (outcome, output) results'''
+        results = [tuple(result) for result in results]
+        with self.lock:
+            self.remember(key, results)
+        self.writeFile(key, results)
+
+
+    def remember(self, key, results):
+        '''Add the results to the in-memory cache, evicting as necessary.
+           Caller must hold the lock.'''
+        if key in self.entries:
+            self.bytesUsed -= self.entries.pop(key)[1]
+        size = sum(len(output) for (outcome, output) in results)
+        self.entries[key] = (results, size)
+        self.bytesUsed += size
+        while self.entries and (len(self.entries) > self.maxEntries or
+                (self.maxBytes is not None and self.bytesUsed > self.maxBytes)):
+            (oldKey, (oldResults, oldSize)) = self.entries.popitem(last=False)
+            self.bytesUsed -= oldSize
+
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+
+    def readFile(self, key):
+        if self.directory is None:
+            return None
+        try:
+            filename = self.filename(key)
+            with open(filename) as f:
+                results = [tuple(result) for result in json.load(f)]
+            os.utime(filename, None)   # Track recency of use for pruning
+            return results
+        except (IOError, OSError, ValueError):
+            return None
+
+
+    def writeFile(self, key, results):
+        if self.directory is None:
+            return
+        (fd, tempName) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(results, f)
+        os.rename(tempName, self.filename(key))   # Atomic, so readers never see part files
+        with self.lock:
+            self.putsSincePrune += 1
+            prune = self.putsSincePrune >= 100
+            if prune:
+                self.putsSincePrune = 0
+        if prune:
+            self.prune()
+
+
+    def prune(self):
+        '''Remove the least recently used files from the disk cache until
+           there are at most maxDiskEntries'''
+        if self.directory is None or self.maxDiskEntries is None:
+            return
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                path = os.path.join(self.directory, name)
+                try:
+                    files.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass   # Removed by another process
+        files.sort()
+        for (mtime, path) in files[:max(0, len(files) - self.maxDiskEntries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
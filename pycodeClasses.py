@@ -1,83 +1,459 @@
+import ast
 import code
+import codeop
+import collections
+import copy
+import errno
+import marshal
+import os
 import sys
+import time
+try:
+    import signal
+except ImportError:
+    signal = None   # E.g. in the pypy sandbox
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import mmap
+except ImportError:
+    mmap = None
+try:
+    import select
+except ImportError:
+    select = None
+
+OUTPUT_TRUNCATED_MESSAGE = '\n*** Output limit exceeded. Further output discarded ***\n'
+TIME_LIMIT_MESSAGE = '\n*** Time limit exceeded ***\n'
+OUTPUT_MISMATCH_MESSAGE = '\n*** Output differs from that expected. Test stopped ***\n'
+TEST_FAILED_MESSAGE = '*** Test process failed ***\n'
+TESTER_FAILED = 'Tester failed'  # The outcome of a test the grader itself failed to run
+TRAILING_WS = '\n '  # Characters stripped from the end of output before comparison
+STUDENT_FILENAMES = ('<input>', '<console>')  # Filenames of code run by the console
+TIMER_REPEAT = 0.05  # Seconds between repeated time-limit interrupts
+HARD_LIMIT_GRACE = 1.0  # Seconds a timed-out test may ignore interrupts before hardExit
+KILL_GRACE = 2.0  # Seconds beyond its time limit before a test's process is killed
+RESULT_GRACE = 10.0  # Seconds beyond their tests' time limits to wait for parallel results
+COMMAND_CACHE_SIZE = 1000  # Most sets of test commands kept compiled (see compileCommands)
+FIXTURE_CACHE_SIZE = 100  # Most fixture directories kept mapped (see mapFixtures)
+
+
+class OutputLimitExceeded (Exception):
+    '''Raised within the student's program when it writes more output than
+       the console's maxOutput limit permits'''
+    pass
+
+
+class TimeLimitExceeded (Exception):
+    '''Raised within the student's program when it exceeds the console's
+       CPU or wall-clock time limit'''
+    pass
+
+
+class OutputMismatch (Exception):
+    '''Raised within the student's program when its output can no longer
+       match the expected output (see PycodeConsole.setExpected)'''
+    pass
+
 
 class PycodeConsole (code.InteractiveConsole):
-    def __init__(self):
+    def __init__(self, maxOutput=None, fileSystem=None, cpuLimit=None,
+                 wallLimit=None, memLimit=None, countLines=False):
+        '''Construct a console. If maxOutput is not None, output beyond
+           that many characters is discarded, outputTruncated is set, and
+           an OutputLimitExceeded exception is raised in the student code.
+           Files opened by the student code live in fileSystem, which
+           defaults to a new empty PycodeFileSystem. If cpuLimit or
+           wallLimit is not None, a test that runs for longer than that
+           many seconds of CPU or elapsed time is interrupted by a
+           TimeLimitExceeded exception and timedOut is set (see runLimited).
+           If memLimit is not None, a test run in a child process may
+           allocate at most that many more bytes of address space; beyond
+           that it gets a MemoryError and memoryExceeded is set (see
+           runInChildProcess). Timing and other metrics are collected
+           as the code runs (see metrics); if countLines is True these
+           include the number of lines of student code executed, which
+           requires a (slow) trace function.
+        '''
         environ = {'__name__': 'PycodeTester',
                    '__doc__': None,
                    'raw_input': self.raw_input,
                    'open': self.open
                   }
         code.InteractiveConsole.__init__(self, environ)
-        self.output = ''
+        self.outputChunks = []
+        self.outputSize = 0
+        self.maxOutput = maxOutput
+        self.outputTruncated = False
         self.syntaxError = self.exception = False
-        self.lineNum = 0
-        self.inputLines = None
+        self.stdin = PycodeStdin(None)
+        self.comparator = None
+        self.outputMismatch = False
+        if fileSystem is None:
+            fileSystem = PycodeFileSystem()
+        self.fileSystem = fileSystem
+        self.cpuLimit = cpuLimit
+        self.wallLimit = wallLimit
+        self.timedOut = False
+        self.timedOutAt = None
+        self.hardExit = None
+        self.tracing = False
+        self.memLimit = memLimit
+        self.memoryExceeded = False
+        self.peakMemory = None
+        self.savedMemLimit = None
+        self.countLines = countLines
+        self.linesExecuted = 0
+        self.compileTime = self.execTime = 0.0
+        self.cpuTime = self.wallTime = 0.0
        
         
     def open(self, filename, mode = 'r'):
         '''Open a file for reading or writing. See 'PycodeFile' class below'''
-        return PycodeFile(filename, mode)
+        return PycodeFile(filename, mode, self.fileSystem)
                 
         
     def setInput(self, inputString):
-        if inputString == None:
-            self.inputLines = None
-        else:
-            inputString.replace('\r', '')
-            while inputString.endswith('\n'):
-                inputString = inputString[:-1]
-            self.inputLines = inputString.split('\n')
-        self.lineNum = 0
-        
-        
+        '''Set the standard input for the next test (see PycodeStdin)'''
+        self.stdin = PycodeStdin(inputString)
+
+
+    def setExpected(self, expected):
+        '''Check all output, including any already written, against the
+           given expected output as it's written. As soon as it provably
+           can't match (see PycodeOutputComparator), outputMismatch is set
+           and an OutputMismatch exception is raised in the student code.
+           An expected output of None turns checking off.'''
+        if expected is None:
+            self.comparator = None
+            return
+        self.comparator = PycodeOutputComparator(expected)
+        if self.outputSize > 0 and not self.comparator.add(self.output):
+            self.mismatchFound()
+
+
+    def mismatchFound(self):
+        self.outputMismatch = True
+        self.comparator = None
+        if not self.outputTruncated:
+            self.outputChunks.append(OUTPUT_MISMATCH_MESSAGE)
+
+
+    @property
+    def inputRequested(self):
+        '''True if the code run so far has tried to read standard input'''
+        return self.stdin.accessed
+
+
+    @property
+    def output(self):
+        '''All output so far, as a single string'''
+        if len(self.outputChunks) > 1:
+            self.outputChunks = [''.join(self.outputChunks)]
+        return self.outputChunks[0] if self.outputChunks else ''
+
+
     def write(self, data):
-        self.output += data
+        if self.outputTruncated:
+            raise OutputLimitExceeded()
+        if self.outputMismatch:
+            raise OutputMismatch()
+        if self.maxOutput is not None and self.outputSize + len(data) > self.maxOutput:
+            self.outputChunks.append(data[:self.maxOutput - self.outputSize])
+            self.outputChunks.append(OUTPUT_TRUNCATED_MESSAGE)
+            self.outputSize = self.maxOutput
+            self.outputTruncated = True
+            raise OutputLimitExceeded()
+        self.outputChunks.append(data)
+        self.outputSize += len(data)
+        if self.comparator is not None and not self.comparator.add(data):
+            self.mismatchFound()
+            raise OutputMismatch()
         
         
     def showsyntaxerror(self, *args):
         self.syntaxError = True
-        code.InteractiveConsole.showsyntaxerror(self, *args)
+        comparator = self.comparator
+        self.comparator = None   # Error reports are never checked
+        try:
+            code.InteractiveConsole.showsyntaxerror(self, *args)
+        finally:
+            self.comparator = comparator
         
         
     def showtraceback(self, *args):
         self.exception = True
-        code.InteractiveConsole.showtraceback(self, *args)
+        if self.memLimit is not None and sys.exc_info()[0] is MemoryError:
+            self.memoryExceeded = True
+        if self.timedOut:
+            self.timeLimitExceeded()
+        elif not self.outputTruncated and not self.outputMismatch:   # Else traceback would be discarded anyway
+            comparator = self.comparator
+            self.comparator = None
+            try:
+                code.InteractiveConsole.showtraceback(self, *args)
+            finally:
+                self.comparator = comparator
+
+
+    def timeLimitExceeded(self):
+        '''Record that the test ran out of time'''
+        self.timedOut = self.exception = True
+        if not self.outputTruncated and not self.output.endswith(TIME_LIMIT_MESSAGE):
+            self.outputChunks.append(TIME_LIMIT_MESSAGE)
+
+
+    def status(self):
+        '''Return a dictionary of the console's output and error flags,
+           from which PycodeTester determines a test's outcome'''
+        return {'output': self.output,
+                'syntaxError': self.syntaxError,
+                'exception': self.exception,
+                'outputTruncated': self.outputTruncated,
+                'timedOut': self.timedOut,
+                'outputMismatch': self.outputMismatch,
+                'memoryExceeded': self.memoryExceeded,
+                'peakMemory': self.peakMemory,
+                'metrics': self.metrics()}
+
+
+    def metrics(self):
+        '''Return a dictionary of metrics about the code run so far: the
+           seconds spent compiling and executing it, the total CPU and
+           elapsed seconds of runLimited calls, the number of characters
+           of output and (if countLines is set, else None) the number
+           of lines of student code executed'''
+        return {'compileTime': self.compileTime,
+                'execTime': self.execTime,
+                'cpuTime': self.cpuTime,
+                'wallTime': self.wallTime,
+                'outputBytes': self.outputSize,
+                'linesExecuted': self.linesExecuted if self.countLines else None}
     
         
     def runsource(self, src, filename='<input>', mode='single'):
+        self.saved_stdin = sys.stdin
         self.saved_stdout = sys.stdout
         self.saved_stderr = sys.stderr
+        sys.stdin = self.stdin
         sys.stdout = self
         sys.stderr = self
-        result = code.InteractiveConsole.runsource(self, src, filename, mode)
-        sys.stdout = self.saved_stdout
-        sys.stderr = self.saved_stderr
-        return result
+        startTime = time.time()
+        startExecTime = self.execTime
+        try:
+            return code.InteractiveConsole.runsource(self, src, filename, mode)
+        except (MemoryError, RuntimeError):
+            # Only compiling can raise these here (runcode reports errors
+            # from running the code), when the code is nested too deeply
+            self.showsyntaxerror(filename)
+            return False
+        finally:
+            sys.stdin = self.saved_stdin
+            sys.stdout = self.saved_stdout
+            sys.stderr = self.saved_stderr
+            self.compileTime += time.time() - startTime - (self.execTime - startExecTime)
+
+
+    def runcode(self, codeObj):
+        '''As InteractiveConsole.runcode, except that SystemExit is also
+           reported as an error, so student code can't end the tester'''
+        startTime = time.time()
+        try:
+            exec codeObj in self.locals
+        except:
+            self.showtraceback()
+        else:
+            if code.softspace(sys.stdout, 0):
+                print
+        finally:
+            self.execTime += time.time() - startTime
+
+
+    def runCompiled(self, codeObj):
+        '''Execute an already-compiled code object in this console's
+           namespace, with input and output redirected as for runsource'''
+        self.saved_stdin = sys.stdin
+        self.saved_stdout = sys.stdout
+        self.saved_stderr = sys.stderr
+        sys.stdin = self.stdin
+        sys.stdout = self
+        sys.stderr = self
+        try:
+            self.runcode(codeObj)
+        finally:
+            sys.stdin = self.saved_stdin
+            sys.stdout = self.saved_stdout
+            sys.stderr = self.saved_stderr
+
+
+    def runLimited(self, func, *args):
+        '''Call func(*args) subject to the console's time limits.
+           The limits are enforced by interval timers when running in the
+           main thread, with the timer signals raising TimeLimitExceeded
+           only when they interrupt the student's code. Elsewhere (e.g. in
+           a thread, or where signals are unavailable) a trace function on
+           the student's code checks the time at each line; this is
+           slower and a student program that catches TimeLimitExceeded
+           can then escape it. If a program keeps catching the repeated
+           interrupts for HARD_LIMIT_GRACE seconds, the hardExit function,
+           if set, is called (see runInChildProcess).
+           The call's CPU and elapsed time are added to the metrics.
+        '''
+        self.startTime = time.time()
+        self.startCpu = time.clock()
+        timers = None
+        if self.cpuLimit is not None or self.wallLimit is not None:
+            timers = self.startTimers()
+            self.tracing = timers is None
+        traced = self.tracing or self.countLines
+        if traced:
+            sys.settrace(self.traceCall)
+        try:
+            return func(*args)
+        except TimeLimitExceeded:
+            self.timeLimitExceeded()
+        finally:
+            if timers:
+                self.stopTimers(timers)
+            if traced:
+                sys.settrace(None)
+            self.tracing = False
+            self.cpuTime += time.clock() - self.startCpu
+            self.wallTime += time.time() - self.startTime
+
+
+    def startTimers(self):
+        '''Start interval timers for the console's time limits, returning
+           a list of (signal, timer, previous handler) triples, or None if
+           interval timers can't be used'''
+        if signal is None or not hasattr(signal, 'setitimer'):
+            return None
+        timers = []
+        limits = [(signal.SIGPROF, signal.ITIMER_PROF, self.cpuLimit),
+                  (signal.SIGALRM, signal.ITIMER_REAL, self.wallLimit)]
+        try:
+            for (sig, timer, limit) in limits:
+                if limit is not None:
+                    oldHandler = signal.signal(sig, self.timerExpired)
+                    timers.append((sig, timer, oldHandler))
+                    signal.setitimer(timer, limit, TIMER_REPEAT)
+        except ValueError:   # Not in main thread
+            self.stopTimers(timers)
+            return None
+        return timers
+
+
+    def stopTimers(self, timers):
+        for (sig, timer, oldHandler) in timers:
+            signal.setitimer(timer, 0)
+            signal.signal(sig, oldHandler)
+
+
+    def startMemoryLimit(self):
+        '''Start measuring this process's peak memory use and, if memLimit
+           is set, limit its further growth. Only for use in a process
+           dedicated to a single test, as the measurement is of the
+           whole process.'''
+        if resource is None:
+            return
+        self.startRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if self.memLimit is not None:
+            self.savedMemLimit = resource.getrlimit(resource.RLIMIT_AS)
+            limit = addressSpaceSize() + self.memLimit
+            hardLimit = self.savedMemLimit[1]
+            if hardLimit != resource.RLIM_INFINITY:
+                limit = min(limit, hardLimit)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, hardLimit))
+
+
+    def stopMemoryLimit(self):
+        '''Lift any memory limit and record the peak memory, in bytes,
+           used since startMemoryLimit'''
+        if resource is None:
+            return
+        if self.savedMemLimit is not None:
+            resource.setrlimit(resource.RLIMIT_AS, self.savedMemLimit)
+            self.savedMemLimit = None
+        maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.peakMemory = max(0, maxRss - self.startRss) * 1024  # ru_maxrss is in kB
+
+
+    def timerExpired(self, signum, frame):
+        if not self.timedOut:
+            self.timedOut = True
+            self.timedOutAt = time.time()
+        elif self.hardExit is not None and time.time() - self.timedOutAt > HARD_LIMIT_GRACE:
+            self.hardExit()
+        if frame is not None and frame.f_code.co_filename in STUDENT_FILENAMES:
+            raise TimeLimitExceeded()
+
+
+    def traceCall(self, frame, event, arg):
+        '''The global trace function, used to count lines and when
+           timers are unavailable'''
+        if frame.f_code.co_filename in STUDENT_FILENAMES:
+            return self.traceLine
+        else:
+            return None
+
+
+    def traceLine(self, frame, event, arg):
+        if event == 'line':
+            self.linesExecuted += 1
+        if self.tracing and (self.timedOut or
+                (self.cpuLimit is not None and time.clock() - self.startCpu > self.cpuLimit) or
+                (self.wallLimit is not None and time.time() - self.startTime > self.wallLimit)):
+            self.timedOut = True
+            raise TimeLimitExceeded()
+        return self.traceLine
 
     
     def raw_input(self, prompt = ''):
-        self.output += prompt
-        if self.inputLines is None or self.lineNum >= len(self.inputLines):
-            raise EOFError
-        line = self.inputLines[self.lineNum]
-        #self.output += "<<{0:d}>>".format(self.lineNum)
-        self.lineNum += 1
-        return line
+        self.write(prompt)
+        return self.stdin.nextInputLine()
 
     
-    def runTest(self, studentCode, interpreterCommands, stdin=None):
+    def runTest(self, studentCode, interpreterCommands, stdin=None, expected=None):
         self.setInput(stdin)
-        cmdLines = interpreterCommands.split('\n')
+        self.setExpected(expected)
+        self.runLimited(self.runProgram, studentCode, interpreterCommands)
+        return self.output
+
+
+    def runProgram(self, studentCode, interpreterCommands):
+        '''Run the student code then the test commands'''
         cmdResult = self.runsource(studentCode, mode='exec')
         if cmdResult:
             self.syntaxError = True
-            self.output += "Program code incomplete (unclosed brackets?)\n"
-            
+            self.write("Program code incomplete (unclosed brackets?)\n")
+        return self.runCommands(interpreterCommands)
+
+
+    def runCommands(self, interpreterCommands):
+        '''Run the given test commands line by line, as if typed at the
+           interactive prompt, in the namespace left by the student code.
+           Returns the total output so far. The commands are normally run
+           precompiled (see compileCommands), falling back to pushing them
+           a line at a time to get the usual error reports if they don't
+           compile.'''
+        codeObjs = compileCommands(interpreterCommands, self.compile)
+        if codeObjs is not None:
+            for codeObj in codeObjs:
+                if (self.syntaxError or self.exception or self.timedOut
+                        or self.outputMismatch):
+                    break
+                self.runCompiled(codeObj)
+            return self.output
+
+        cmdLines = interpreterCommands.split('\n')
         self.commandsRun = 0
         cmdResult = False
 
-        while self.commandsRun < len(cmdLines) and not self.syntaxError and not self.exception:
+        while (self.commandsRun < len(cmdLines) and not self.syntaxError
+                and not self.exception and not self.timedOut
+                and not self.outputMismatch):
             line = cmdLines[self.commandsRun]
             cmdResult = self.push(line)
             self.commandsRun += 1
@@ -86,43 +462,135 @@ class PycodeConsole (code.InteractiveConsole):
         return self.output
 
 
+'''A PycodeFileSystem is the flat set of files visible to one console.
+   It may be seeded with a dictionary of fixture files (name -> contents,
+   either a string or a memory-mapped file from mapFixtures) provided by
+   the question; these are shared, not copied, until the student code
+   opens one for writing or appending. If quota is not
+   None, the total size of the files written is limited to that many
+   characters and writes beyond it raise IOError.
+'''
+class PycodeFileSystem (object):
+    def __init__(self, fixtures=None, quota=None):
+        self.fixtures = fixtures if fixtures is not None else {}
+        self.quota = quota
+        self.reset()
+
+    def reset(self):
+        '''Discard all files written, reverting to just the fixtures'''
+        self.files = {}  # A map from file name to PycodeFileContents
+        self.used = 0
+
+    def __contains__(self, filename):
+        return filename in self.files or filename in self.fixtures
+
+    def __len__(self):
+        return len(self.files)
+
+    def get(self, filename):
+        '''The contents of the given file, which must exist'''
+        if filename in self.files:
+            return self.files[filename]
+        else:
+            return PycodeFileContents(None, self.fixtures[filename])
+
+    def create(self, filename, initialContents=''):
+        '''Create (or recreate) a writable file with the given contents'''
+        if filename in self.files:
+            self.files[filename].truncate(0)
+        contents = PycodeFileContents(self, '')
+        contents.append(initialContents)
+        self.files[filename] = contents
+        return contents
+
+    def allocate(self, n):
+        '''Record n more characters as used, checking the quota'''
+        if self.quota is not None and self.used + n > self.quota:
+            raise IOError('File system quota of {0} bytes exceeded'.format(self.quota))
+        self.used += n
+
+
+'''The contents of a single file in a PycodeFileSystem. The contents are
+   kept as a list of chunks so that appending is cheap; the chunks are
+   joined into a single string only when the file is read. Contents with
+   no file system are read-only fixtures, whose single chunk may be an
+   mmap, which is sliced and searched like a string without being copied.
+'''
+class PycodeFileContents (object):
+    def __init__(self, fileSystem, s=''):
+        self.fileSystem = fileSystem
+        self.chunks = [s] if s else []
+        self.length = len(s)
+
+    def __len__(self):
+        return self.length
+
+    def value(self):
+        '''Return the contents as a single string'''
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0] if self.chunks else ''
+
+    def append(self, s):
+        if s:
+            self.fileSystem.allocate(len(s))
+            self.chunks.append(s)
+            self.length += len(s)
+
+    def truncate(self, size):
+        if size < self.length:
+            self.chunks = [self.value()[:size]]
+            self.fileSystem.used -= self.length - size
+            self.length = size
+
+
 '''The PycodeFile class implements a rudimentary flat-file system so that
    questions can be set that ask students to read or write files.
    The only open modes permitted are r, w and a, with an optional b
-   that is ignored (i.e., r+, w+, a+ are not allowed). 
+   (i.e., r+, w+, a+ are not allowed). In binary mode data is read exactly
+   as stored; in text mode '\r\n' line endings (e.g. in fixture files
+   prepared on Windows) are read as '\n'. Files live in the given
+   PycodeFileSystem.
 '''
 class PycodeFile:
-    file_sys = {}  # A map from file name to string contents of file
-    
-    def __init__(self, filename, mode):
+    def __init__(self, filename, mode, fileSystem):
+        self.binary = 'b' in mode
         mode = mode.replace('b', '')
         self.filename = filename
         self.mode = mode
         self.closed = False
+        self.file_sys = fileSystem
         if mode not in ['r', 'w', 'a']:
             raise ValueError("Bad call to 'open'. In Pycode, mode string must be one of 'r', 'w', or 'a'")
-        if mode == 'r' and filename not in PycodeFile.file_sys:
+        if mode == 'r' and filename not in fileSystem:
             raise IOError('File {0} not found'.format(filename))
-        if mode == 'w' or (mode == 'a' and filename not in PycodeFile.file_sys):
-            PycodeFile.file_sys[filename] = ''
+        if mode == 'w' or (mode == 'a' and filename not in fileSystem):
+            fileSystem.create(filename)
+        elif mode == 'a' and filename not in fileSystem.files:
+            fileSystem.create(filename, fileSystem.get(filename).value()[:])  # Copy on write
         if mode != 'a':
             self.file_pos = 0
         else:
-            self.file_pos = len(PycodeFile.file_sys[filename])
+            self.file_pos = len(fileSystem.get(filename))
         
     def read(self, n = -1):
         self.check_open('r')
-        contents = PycodeFile.file_sys[self.filename]
+        contents = self.file_sys.get(self.filename).value()
         if n >= 0:
             end_pos = min(len(contents), self.file_pos + n)
         else:
             end_pos = len(contents)
-        result = contents[self.file_pos : end_pos]
+        if self.binary:
+            result = contents[self.file_pos : end_pos]
+        else:
+            if end_pos > 0 and contents[end_pos - 1 : end_pos + 1] == '\r\n':
+                end_pos += 1   # Don't split a line ending
+            result = contents[self.file_pos : end_pos].replace('\r\n', '\n')
         self.file_pos = end_pos
         return result
       
     def readline(self):
-        contents = PycodeFile.file_sys[self.filename]
+        contents = self.file_sys.get(self.filename).value()
         if self.file_pos >= len(contents):
             return ''
         else:	
@@ -140,7 +608,7 @@ class PycodeFile:
         return result
     
     def seek(self, offset, whence = 0):
-        file_length = len(PycodeFile.file_sys[self.filename])
+        file_length = len(self.file_sys.get(self.filename))
         if whence == 0:
             self.file_pos = offset
         elif whence == 1:
@@ -183,14 +651,13 @@ class PycodeFile:
     
     def write(self, s):
         self.check_open('w')
-        contents = PycodeFile.file_sys[self.filename]
-        new_contents = contents[:self.file_pos] + s
-        PycodeFile.file_sys[self.filename] = new_contents
-        self.file_pos = len(new_contents)
+        contents = self.file_sys.get(self.filename)
+        contents.truncate(self.file_pos)
+        contents.append(s)
+        self.file_pos = len(contents)
     
     def writelines(self, lines):
-        for line in lines:
-            self.write(line)
+        self.write(''.join(lines))
             
     def tell(self):
         return self.file_pos
@@ -199,63 +666,827 @@ class PycodeFile:
         self.check_open('w')
         if size is None:
             size = self.file_pos
-        contents = PycodeFile.file_sys[self.filename]
-        if size < len(contents):
-            PycodeFile.file_sys[self.filename] = contents[:size]
+        self.file_sys.get(self.filename).truncate(size)
    
 
 
+'''A PycodeStdin is the standard input of a test, served lazily from the
+   test's stdin string so that large inputs aren't split or copied up front.
+   It replaces sys.stdin while student code runs, supporting read, readline,
+   readlines and iteration, and also feeds the console's raw_input. Carriage
+   returns are dropped, so CRLF input reads as plain newlines. For
+   raw_input, trailing newlines at the end of the input are ignored and an
+   input of None is empty; either way EOFError is raised once the input
+   lines are exhausted.
+'''
+class PycodeStdin (object):
+    def __init__(self, inputString):
+        self.data = inputString if inputString is not None else ''
+        self.pos = 0
+        self.accessed = False
+        self.closed = False
+        self.encoding = None
+        self.mode = 'r'
+        self.name = '<stdin>'
+        if inputString is None:
+            self.end = -1   # No lines at all for raw_input
+        else:
+            self.end = len(self.data)
+            while self.end > 0 and self.data[self.end - 1] in '\r\n':
+                self.end -= 1
+
+    def nextInputLine(self):
+        '''The next line for raw_input, without its line terminator'''
+        self.accessed = True
+        if self.pos > self.end:
+            raise EOFError
+        newline = self.data.find('\n', self.pos, self.end)
+        if newline < 0:
+            newline = self.end
+        line = self.data[self.pos:newline]
+        self.pos = newline + 1
+        return line.replace('\r', '')
+
+    def read(self, n = -1):
+        self.accessed = True
+        if n is None or n < 0:
+            n = len(self.data)
+        chunks = []
+        while n > 0 and self.pos < len(self.data):
+            chunk = self.data[self.pos:self.pos + n]
+            self.pos += len(chunk)
+            chunk = chunk.replace('\r', '')
+            chunks.append(chunk)
+            n -= len(chunk)
+        return ''.join(chunks)
+
+    def readline(self, size = -1):
+        self.accessed = True
+        newline = self.data.find('\n', self.pos)
+        stop = len(self.data) if newline < 0 else newline + 1
+        if size is not None and size >= 0:
+            stop = min(stop, self.pos + size)
+        line = self.data[self.pos:stop]
+        self.pos = stop
+        return line.replace('\r', '')
+
+    def readlines(self, sizehint = -1):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if line == '':
+            raise StopIteration
+        return line
+
+    def isatty(self):
+        return False
+
+    def close(self):
+        self.closed = True
+
+
+'''A PycodeOutputComparator checks output, fed to it a piece at a time,
+   against an expected output, under the rule that the two match if they're
+   equal after stripping trailing TRAILING_WS characters. It can thus tell
+   that output can't match as soon as it differs from the stripped expected
+   output or has anything other than TRAILING_WS characters beyond it.
+   The checks are linear in the output length and make no copies of the
+   expected output.
+'''
+class PycodeOutputComparator (object):
+    def __init__(self, expected):
+        self.expected = expected
+        self.expectedLength = len(expected.rstrip(TRAILING_WS))
+        self.length = 0   # Total length of the output added so far
+        self.mismatch = False
+
+    def add(self, data):
+        '''Add the next piece of output. Returns False if the output
+           so far provably doesn't match the expected output.'''
+        if self.mismatch:
+            return False
+        start = self.length
+        self.length += len(data)
+        # The part of data within the stripped expected output must equal it
+        split = max(0, min(len(data), self.expectedLength - start))
+        if split > 0 and not self.expected.startswith(data[:split], start):
+            self.mismatch = True
+        # The rest may only be trailing whitespace
+        elif split < len(data) and len(data.rstrip(TRAILING_WS)) > split:
+            self.mismatch = True
+        return not self.mismatch
+
+
+'''A PycodeSnapshot holds a student's program compiled once, with its
+   top level already executed into a pristine PycodeConsole. Each test is
+   then run in a forked child process that inherits a copy-on-write image
+   of that console, so the student's module is parsed, compiled and run
+   only once per submission. Where fork isn't available (e.g. inside
+   a sandbox that forbids it) each test instead gets a fresh console that
+   re-executes the precompiled code object.
+   Use PycodeSnapshot.create, passing a function that returns a new
+   suitably configured console. It returns None if the program can't be
+   snapshotted (syntax error, incomplete code, a runtime error in the top
+   level or a top level that reads stdin); the caller should then fall
+   back to running each test from source to get the usual error reports.
+   If the console has time or memory limits and fork is available, the top
+   level is first tried in a child process (see runInChildProcess) so that
+   one that won't stop is killed rather than hanging the caller, and one
+   that uses too much memory is stopped by the memory limit; if it fails
+   there it isn't snapshotted.
+'''
+class PycodeSnapshot (object):
+    def __init__(self, console, codeObj, makeConsole):
+        self.console = console
+        self.codeObj = codeObj
+        self.makeConsole = makeConsole
+        self.canFork = hasattr(os, 'fork')
+
+
+    @staticmethod
+    def create(studentCode, makeConsole=PycodeConsole):
+        pc = makeConsole()
+        try:
+            codeObj = pc.compile(studentCode, '<input>', 'exec')
+        except (OverflowError, SyntaxError, ValueError, MemoryError, RuntimeError):
+            return None
+        if codeObj is None:
+            return None   # Incomplete code
+        limited = (pc.cpuLimit is not None or pc.wallLimit is not None
+                   or pc.memLimit is not None)
+        if limited and hasattr(os, 'fork'):
+            trial = makeConsole()
+            try:
+                status = runInChildProcess(trial, trial.runLimited, trial.runCompiled, codeObj)
+            except OSError:
+                status = None
+            if status is not None and status['exception']:
+                return None
+        pc.runLimited(pc.runCompiled, codeObj)
+        if pc.exception or pc.inputRequested:
+            return None
+        return PycodeSnapshot(pc, codeObj, makeConsole)
+
+
+    def runTest(self, interpreterCommands, stdin=None, expected=None):
+        '''Run a single test from the snapshot, checking its output against
+           expected if not None (see PycodeConsole.setExpected). Returns the
+           status dictionary of the console that ran it (see
+           PycodeConsole.status).
+        '''
+        if self.canFork:
+            try:
+                return runInChildProcess(self.console, self.runFromSnapshot,
+                                         interpreterCommands, stdin, expected)
+            except OSError:
+                self.canFork = False
+        pc = self.makeConsole()
+        pc.compile = copy.deepcopy(self.console.compile)
+        pc.setInput(stdin)
+        pc.setExpected(expected)
+        pc.runLimited(self.runFromCodeObject, pc, interpreterCommands)
+        return pc.status()
+
+
+    def runFromSnapshot(self, interpreterCommands, stdin, expected):
+        self.console.setInput(stdin)
+        self.console.setExpected(expected)
+        self.console.runLimited(self.console.runCommands, interpreterCommands)
+
+
+    def runFromCodeObject(self, pc, interpreterCommands):
+        pc.runCompiled(self.codeObj)
+        pc.runCommands(interpreterCommands)
+
+
+
+'''Call func(*args), which runs a test on the console pc, in a forked child
+   process and return the console's status (see PycodeConsole.status) as
+   it is at the end of the call in the child. The child gets a copy-on-write
+   image of the parent, so nothing the test does affects the parent. The
+   console's hardExit is set so that a test that won't stop when it times
+   out can be killed without losing its output, and the child's memory use
+   is measured and limited (see PycodeConsole.startMemoryLimit). As the
+   child can only notice its time limits between bytecodes, the parent
+   also kills it, losing its output, if it hasn't finished KILL_GRACE
+   seconds after its wall (else CPU) time limit. A child that dies without
+   reporting its status gives a runtime error, or if it was killed by a
+   signal while its memory was limited (as when an allocation fails where
+   no MemoryError can be raised), a memory limit error.
+   Raises OSError if the fork fails.
+'''
+def runInChildProcess(pc, func, *args):
+    (readFd, writeFd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(readFd)
+        def sendStatusAndExit():
+            with os.fdopen(writeFd, 'wb') as pipe:
+                pipe.write(marshal.dumps(pc.status()))
+            os._exit(0)
+        def hardExit():
+            pc.timeLimitExceeded()
+            pc.stopMemoryLimit()
+            sendStatusAndExit()
+        try:
+            pc.hardExit = hardExit
+            pc.startMemoryLimit()
+            try:
+                func(*args)
+            finally:
+                pc.stopMemoryLimit()
+            sendStatusAndExit()
+        finally:
+            os._exit(1)
+
+    os.close(writeFd)
+    limit = pc.wallLimit if pc.wallLimit is not None else pc.cpuLimit
+    if limit is None or select is None or signal is None:
+        deadline = None
+    else:
+        deadline = time.time() + limit + KILL_GRACE
+    try:
+        result = readUntil(readFd, deadline)
+    finally:
+        os.close(readFd)
+    if result is None:
+        os.kill(pid, signal.SIGKILL)
+    exitStatus = os.waitpid(pid, 0)[1]
+    if result:
+        return marshal.loads(result)
+    elif result is None:
+        return failedChildStatus(TIME_LIMIT_MESSAGE, timedOut=True)
+    else:
+        return failedChildStatus(TEST_FAILED_MESSAGE, memoryExceeded=(
+            pc.memLimit is not None and os.WIFSIGNALED(exitStatus)))
+
+
+def readUntil(fd, deadline):
+    '''Read from fd until end of file, returning the data read, or None
+       if the time deadline (if not None) passes first'''
+    chunks = []
+    while True:
+        if deadline is not None:
+            try:
+                ready = select.select([fd], [], [], max(0, deadline - time.time()))[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                return None
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            return ''.join(chunks)
+        chunks.append(chunk)
+
+
+def failedChildStatus(output, timedOut=False, memoryExceeded=False):
+    '''The status of a test whose child process died or was killed'''
+    return {'output': output,
+            'syntaxError': False,
+            'exception': True,
+            'outputTruncated': False,
+            'timedOut': timedOut,
+            'outputMismatch': False,
+            'memoryExceeded': memoryExceeded,
+            'peakMemory': None,
+            'metrics': None}
+
+
+
+# Test commands compiled by compileCommands, most recently used last
+compiledCommands = collections.OrderedDict()
+
+def compileCommands(interpreterCommands, compiler):
+    '''Return the given test commands compiled, as the console would
+       compile them when they're pushed a line at a time, into a list of
+       interactive ('single' mode) code objects, so that the values of
+       expression statements are still echoed. compiler is the console's
+       codeop.CommandCompiler, whose __future__ flags (set by the student
+       code) affect the compilation. Returns None if the commands don't
+       compile, leaving the console to report the error. Results are cached
+       by commands and flags, so each question's tests are compiled just
+       once per process.'''
+    key = (interpreterCommands, compiler.compiler.flags)
+    if key in compiledCommands:
+        codeObjs = compiledCommands.pop(key)
+    else:
+        codeObjs = compileCommandLines(interpreterCommands.split('\n'),
+                                       copy.deepcopy(compiler))
+    compiledCommands[key] = codeObjs
+    if len(compiledCommands) > COMMAND_CACHE_SIZE:
+        compiledCommands.popitem(last=False)
+    return codeObjs
+
+
+def compileCommandLines(cmdLines, compiler):
+    '''Compile the given lines as compileCommands, returning None if they
+       don't compile or are left incomplete'''
+    codeObjs = []
+    buffer = []
+    try:
+        for line in cmdLines:
+            buffer.append(line)
+            codeObj = compiler('\n'.join(buffer), '<console>', 'single')
+            if codeObj is not None:
+                codeObjs.append(codeObj)
+                buffer = []
+        blankLines = 0
+        while buffer:   # Close off any incomplete input, as runCommands does
+            if blankLines == 2:
+                return None   # Never complete
+            buffer.append('')
+            blankLines += 1
+            codeObj = compiler('\n'.join(buffer), '<console>', 'single')
+            if codeObj is not None:
+                codeObjs.append(codeObj)
+                buffer = []
+    except (OverflowError, SyntaxError, ValueError):
+        return None
+    return codeObjs
+
+
+# Fixture directories mapped by mapFixtures: directory -> (signature, files),
+# most recently used last
+mappedFixtures = collections.OrderedDict()
+
+def mapFixtures(directory):
+    '''Return a dictionary (name -> contents) of the regular files in the
+       given directory, for use as read-only fixtures (see
+       PycodeFileSystem). Each file is mapped into memory rather than read,
+       so that it's loaded lazily and its pages are shared with every other
+       process mapping it, including forked test processes and the other
+       workers of a PycodeWorkerPool. The mappings of the
+       FIXTURE_CACHE_SIZE most recently used directories are kept, and
+       remade if the directory's files change; older ones are closed, so
+       the files returned mustn't be used once that many other directories
+       have been mapped. Where mmap isn't available the files are read
+       instead.'''
+    directory = os.path.abspath(directory)
+    signature = fixtureSignature(directory)
+    if directory in mappedFixtures:
+        (oldSignature, files) = mappedFixtures.pop(directory)
+        if oldSignature == signature:
+            mappedFixtures[directory] = (signature, files)
+            return files
+        closeFixtures(files)
+    files = {}
+    for (name, size, mtime) in signature:
+        with open(os.path.join(directory, name), 'rb') as f:
+            if size == 0:
+                files[name] = ''   # Empty files can't be mapped
+            elif mmap is not None:
+                files[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                files[name] = f.read()
+    mappedFixtures[directory] = (signature, files)
+    if len(mappedFixtures) > FIXTURE_CACHE_SIZE:
+        closeFixtures(mappedFixtures.popitem(last=False)[1][1])
+    return files
+
+
+def closeFixtures(files):
+    '''Close the mappings of the given files from mapFixtures'''
+    for contents in files.values():
+        if mmap is not None and isinstance(contents, mmap.mmap):
+            contents.close()
+
+
+def fixtureSignature(directory):
+    '''A sorted tuple of (name, size, modification time) triples of the
+       regular files in the given directory, which changes if the files do'''
+    signature = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            info = os.stat(path)
+            signature.append((name, info.st_size, info.st_mtime))
+    return tuple(sorted(signature))
+
+
+def screenCode(studentCode, disallowedImports=None, disallowedCalls=None):
+    '''Check the student code without running it. Returns None if it
+       passes, else an (outcome, output) pair for the first test. A syntax
+       error gives the same 'Syntax Error' result as running the code would.
+       Importing any module (or submodule of a module) in disallowedImports,
+       or calling any function named in disallowedCalls (by simple or
+       dotted name, e.g. 'eval' or 'os.system'; 'exec' also covers the
+       exec statement), gives outcome 'Disallowed Code', as does code too
+       deeply nested to check. Without disallowed imports or calls only
+       the (cheap) compile check is done. Compiling untrusted code can
+       still crash the process, so screen it only where that's safe, e.g.
+       in a grading worker.'''
+    if not studentCode.endswith('\n'):
+        studentCode += '\n'   # As PycodeTester does
+    try:
+        codeObj = codeop.CommandCompiler()(studentCode, '<input>', 'exec')
+    except (OverflowError, SyntaxError, ValueError, MemoryError, RuntimeError):
+        pc = PycodeConsole()
+        pc.showsyntaxerror('<input>')
+        return ('Syntax Error', pc.output)
+    if codeObj is None:
+        return ('Syntax Error', 'Program code incomplete (unclosed brackets?)\n')
+    if not disallowedImports and not disallowedCalls:
+        return None
+    disallowedImports = set(disallowedImports or [])
+    disallowedCalls = set(disallowedCalls or [])
+    try:
+        tree = ast.parse(studentCode, '<input>')
+    except (MemoryError, RuntimeError):
+        return ('Disallowed Code', 'Program too deeply nested to check\n')
+    for node in ast.walk(tree):
+        problem = None
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            modules = [node.module or '']
+        else:
+            modules = []
+        for module in modules:
+            parts = module.split('.')
+            if any('.'.join(parts[:i]) in disallowedImports for i in range(1, len(parts) + 1)):
+                problem = 'import of {0}'.format(module)
+        if isinstance(node, ast.Call) and dottedName(node.func) in disallowedCalls:
+            problem = 'call of {0}'.format(dottedName(node.func))
+        elif isinstance(node, ast.Exec) and 'exec' in disallowedCalls:
+            problem = 'exec'
+        if problem is not None:
+            return ('Disallowed Code', 'Line {0}: {1} is not allowed\n'.format(node.lineno, problem))
+    return None
+
+
+def dottedName(node):
+    '''The dotted name of a Name or Attribute node, or None'''
+    if isinstance(node, ast.Name):
+        return node.id
+    elif isinstance(node, ast.Attribute):
+        prefix = dottedName(node.value)
+        return prefix + '.' + node.attr if prefix is not None else None
+    else:
+        return None
+
+
+def addressSpaceSize():
+    '''Return the current size in bytes of this process's address space,
+       or 0 if it can't be determined'''
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[0])
+        return pages * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        return 0
+
+
+
 class PycodeTester (object):
-    def __init__(self, code):
+    def __init__(self, code, compileOnce=False, maxOutput=None,
+                 files=None, fileQuota=None, processes=1, cache=None,
+                 cpuLimit=None, wallLimit=None, memLimit=None, metrics=False,
+                 stopOnMismatch=False, disallowedImports=None, disallowedCalls=None,
+                 runAll=False, fixtureDir=None, failFast=False, countLines=False):
+        '''Construct a tester for the given student code. If compileOnce
+           is True, the code is compiled and its top level run just once,
+           with each test run from a snapshot of the result
+           (see PycodeSnapshot). If maxOutput is not None, each test's
+           output is limited to that many characters (see PycodeConsole).
+           Each test gets its own file system, seeded from the dictionary
+           files (name -> contents) and the read-only files in the directory
+           fixtureDir, if not None (see mapFixtures), and limited to
+           fileQuota characters of written data (see PycodeFileSystem). If processes is greater
+           than 1, tests are run in parallel in a pool of that many
+           processes (see runTestsParallel). If cache is not None, it's
+           used to look up and save results (see pycodeCache.py). If
+           cpuLimit or wallLimit is not None, each test is limited to that
+           many seconds of CPU or elapsed time, and if memLimit is not None
+           to that many bytes of extra memory (see PycodeConsole). After
+           runTests, testDetails holds a dictionary of further details
+           for each result (see runTest). If metrics is True, those
+           details include timing and other metrics for each test, and
+           submissionMetrics is set to a summary of them for the whole
+           submission (see summariseMetrics); only if countLines is also
+           True do they include the number of lines executed, which needs
+           a slow trace function. If stopOnMismatch is True,
+           each test's output is checked as it's written and the test is
+           stopped, with outcome 'No', as soon as the output can't match
+           (see PycodeConsole.setExpected); the output reported for such a
+           test is then only that up to the mismatch. The code is first
+           compiled, and screened for any disallowedImports or
+           disallowedCalls, and not run at all if it has a syntax error or
+           uses any of them (see screenCode). If
+           runAll is True, testing continues after errors other than syntax
+           errors and if failFast is True it stops at the first test that
+           fails in any way, for when only the verdict is wanted (see
+           runTests). failFast overrides runAll.'''
         if code.endswith('\n'):
             self.studentCode = code
         else:
             self.studentCode = code + '\n'
+        self.compileOnce = compileOnce
+        self.maxOutput = maxOutput
+        self.files = files
+        self.fixtureDir = fixtureDir
+        self.fixtures = files
+        if fixtureDir is not None:
+            self.fixtures = dict(mapFixtures(fixtureDir))
+            self.fixtures.update(files or {})
+        self.fileQuota = fileQuota
+        self.processes = processes
+        self.cache = cache
+        self.cpuLimit = cpuLimit
+        self.wallLimit = wallLimit
+        self.memLimit = memLimit
+        self.collectMetrics = metrics
+        self.countLines = metrics and countLines
+        self.stopOnMismatch = stopOnMismatch
+        self.disallowedImports = disallowedImports
+        self.disallowedCalls = disallowedCalls
+        self.runAll = runAll
+        self.failFast = failFast
+        self.testDetails = []
+        self.submissionMetrics = None
+        self.setupTime = 0.0
+
+
+    def makeConsole(self):
+        '''Return a new console, with a fresh file system, for running
+           a single test'''
+        return PycodeConsole(self.maxOutput,
+                             PycodeFileSystem(self.fixtures, self.fileQuota),
+                             self.cpuLimit, self.wallLimit, self.memLimit,
+                             self.countLines)
+
+
+    def makeSnapshot(self):
+        '''Return a PycodeSnapshot of the student code if running in
+           compileOnce mode and the code can be snapshotted, else None'''
+        if self.compileOnce:
+            return PycodeSnapshot.create(self.studentCode, self.makeConsole)
+        else:
+            return None
             
             
     def stripTrailingWs(self, s):
         '''Return s with trailing whitespace stripped'''
-        while s.endswith(('\n', ' ')):
-            s = s[0:-1]
-        return s
+        return s.rstrip(TRAILING_WS)
         
         
     def runTests(self, tests):
         '''Run the given set of tests with the code provided to the
            constructor. Returns a list of result pairs, each consisting
-           of the string 'Yes', 'No', 'Syntax Error' or 'Runtime Error'
-           and the actual output received. 'Yes' indicates that the
+           of the string 'Yes', 'No', 'Syntax Error', 'Runtime Error',
+           'Output Limit Exceeded', 'Timeout' or 'Memory Limit Exceeded'
+           and the actual output received (or 'Disallowed Code' and an
+           explanation, see screenCode), or TESTER_FAILED if the grader
+           itself failed to run a test. 'Yes' indicates that the
            output matches the expected value. Trailing whitespace is
-           removed prior to the equality test. Leading whitespace,
-           or trailing whitespace on lines other than the first, is
-           not removed.
+           removed prior to the equality test. Leading whitespace, or
+           trailing whitespace on lines other than the first, is not
+           removed. Testing stops after the first test with an outcome
+           other than 'Yes' or 'No' or, in runAll mode, after a syntax error
+           only, so that all other tests are run and reported, or in
+           failFast mode after the first test with any outcome other than
+           'Yes'. Callers wanting a quick verdict should give the tests
+           likeliest to fail first.
            '''
+        startTime = time.time()
+        self.setupTime = 0.0
+        screened = screenCode(self.studentCode, self.disallowedImports, self.disallowedCalls)
+        if screened is not None:
+            results = [screened] if tests else []
+            self.testDetails = [{'peakMemory': None, 'metrics': None} for result in results]
+            cached = False
+        elif self.cache is None:
+            results = self.runTestsUncached(tests)
+            cached = False
+        else:
+            (results, cached) = self.runTestsCached(tests)
+        if self.collectMetrics:
+            self.submissionMetrics = self.summariseMetrics(results, cached,
+                                                           time.time() - startTime)
+        return results
+
+
+    def runTestsCached(self, tests):
+        '''Run the given tests as for runTests, returning the results
+           from the cache if possible. Returns a pair (results, cached)
+           where cached is True if the results came from the cache.'''
+        options = {'maxOutput': self.maxOutput,
+                   'files': self.files,
+                   'fixtures': (self.fixtureDir and
+                                [self.fixtureDir, fixtureSignature(self.fixtureDir)]),
+                   'fileQuota': self.fileQuota,
+                   'cpuLimit': self.cpuLimit,
+                   'wallLimit': self.wallLimit,
+                   'memLimit': self.memLimit,
+                   'stopOnMismatch': self.stopOnMismatch,
+                   'runAll': self.runAll,
+                   'failFast': self.failFast}
+        key = self.cache.key(self.studentCode, tests, options)
+        results = self.cache.get(key)
+        if results is not None:
+            self.testDetails = [{'peakMemory': None, 'metrics': None} for result in results]
+            return (results, True)
+        results = self.runTestsUncached(tests)
+        outcomes = [outcome for (outcome, output) in results]
+        if 'Timeout' not in outcomes and TESTER_FAILED not in outcomes:
+            self.cache.put(key, results)   # Timeouts and failures depend on load so aren't cached
+        return (results, False)
+
+
+    def summariseMetrics(self, results, cached, totalTime):
+        '''Return a dictionary of metrics for a whole submission: the
+           number of tests run, whether the results came from the cache,
+           the total elapsed time, the time taken to set up a snapshot,
+           a count of each outcome and the totals over all tests of each
+           per-test metric (see runTest)'''
+        summary = {'tests': len(results),
+                   'cached': cached,
+                   'totalTime': totalTime,
+                   'setupTime': self.setupTime,
+                   'outcomes': {}}
+        for (outcome, output) in results:
+            summary['outcomes'][outcome] = summary['outcomes'].get(outcome, 0) + 1
+        for details in self.testDetails:
+            for (name, value) in (details['metrics'] or {}).items():
+                if value is not None:
+                    summary[name] = summary.get(name, 0) + value
+        return summary
+
+
+    def runTestsUncached(self, tests):
+        '''Run the given tests as for runTests, without using the cache'''
+        if self.processes > 1 and len(tests) > 1:
+            return self.runTestsParallel(tests)
+
         results = []
+        self.testDetails = []
         i = 0
         abort = False
+        startTime = time.time()
+        snapshot = self.makeSnapshot()
+        self.setupTime = time.time() - startTime
         while i < len(tests) and not abort:
-            if len(tests[i]) == 2:
-                (testInput, expected) = tests[i]
-                stdin = None
-            else:
-                (testInput, stdin, expected) = tests[i]
-            pc = PycodeConsole()
-            output = pc.runTest(self.studentCode, testInput, stdin)
-            if pc.syntaxError:
-                outcome = 'Syntax Error'
-            elif pc.exception:
-                outcome = 'Runtime Error'
-            elif self.stripTrailingWs(output) == self.stripTrailingWs(expected):
-                outcome = 'Yes'
-            else:
-                outcome = 'No'  # debug: + ' ' + comparison(output, expected)
+            (outcome, output, details) = self.runTest(tests[i], snapshot)
             results.append( (outcome, output) )
-            if pc.syntaxError or pc.exception:
-                abort = True
+            self.testDetails.append(details)
+            abort = self.stopsTesting(outcome)
             i += 1
             
         return results
 
+
+    def stopsTesting(self, outcome):
+        '''True if a test with the given outcome ends the testing'''
+        if outcome == TESTER_FAILED:
+            return True
+        elif self.failFast:
+            return outcome != 'Yes'
+        elif self.runAll:
+            return outcome == 'Syntax Error'   # Which affects every test
+        else:
+            return outcome not in ('Yes', 'No')
+
+
+    def runTestsParallel(self, tests):
+        '''Run the given tests as for runTests but spread across a pool
+           of self.processes worker processes. Results are collected in
+           the original order and the pool is terminated, cancelling any
+           tests still running or queued, as soon as a result that stops
+           testing is found (see stopsTesting). In compileOnce mode the
+           snapshot is made before the workers start, so they share it.
+           Each test runs in a child process of its worker, so nothing it
+           does can kill the worker, and if the tests have time limits
+           the results are abandoned, with outcome TESTER_FAILED, if
+           they're not all in RESULT_GRACE seconds after the limits of
+           every test have passed.
+        '''
+        import multiprocessing   # Not at module level: it needs signal, which the sandbox lacks
+        startTime = time.time()
+        snapshot = self.makeSnapshot()
+        self.setupTime = time.time() - startTime
+        limit = self.wallLimit if self.wallLimit is not None else self.cpuLimit
+        deadline = None
+        if limit is not None:
+            deadline = time.time() + len(tests) * (limit + KILL_GRACE) + RESULT_GRACE
+        pool = multiprocessing.Pool(min(self.processes, len(tests)),
+                                    parallelWorkerInit, (self, snapshot))
+        results = []
+        self.testDetails = []
+        try:
+            replies = pool.imap(parallelWorkerRunTest, tests)
+            for i in range(len(tests)):
+                try:
+                    if deadline is None:
+                        (outcome, output, details) = replies.next()
+                    else:
+                        (outcome, output, details) = replies.next(max(0, deadline - time.time()))
+                except multiprocessing.TimeoutError:
+                    (outcome, output, details) = (TESTER_FAILED, '*** No result from test process ***\n',
+                                                  {'peakMemory': None, 'metrics': None})
+                results.append( (outcome, output) )
+                self.testDetails.append(details)
+                if self.stopsTesting(outcome):
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+        return results
+
+
+    def runTest(self, test, snapshot=None, isolated=False):
+        '''Run a single test, which is a pair (testcode, expected) or a
+           triple (testcode, stdin, expected), from the given snapshot if
+           not None or else from source. Tests with limits, or all tests if
+           isolated is True, are run in a child process where possible
+           (snapshots always do so). Returns a triple (outcome, output,
+           details) where outcome and output are as described in runTests
+           and details is a dictionary with keys:
+             'peakMemory': the bytes of memory used by the test if it was
+                           run in a child process, else None;
+             'metrics': if collecting metrics, a dictionary of the console's
+                        metrics (see PycodeConsole.metrics) plus the test's
+                        total elapsed time ('testTime') and the time spent
+                        comparing its output ('compareTime'), else None.
+        '''
+        startTime = time.time()
+        if len(test) == 2:
+            (testInput, expected) = test
+            stdin = None
+        else:
+            (testInput, stdin, expected) = test
+        checkedOutput = expected if self.stopOnMismatch else None
+        if snapshot is not None:
+            status = snapshot.runTest(testInput, stdin, checkedOutput)
+        else:
+            pc = self.makeConsole()
+            status = None
+            limited = (self.cpuLimit is not None or self.wallLimit is not None
+                       or self.memLimit is not None)
+            if (limited or isolated) and hasattr(os, 'fork'):
+                # Run in a child process so a test that won't stop can be
+                # killed and memory can be limited without affecting us
+                try:
+                    status = runInChildProcess(pc, pc.runTest, self.studentCode,
+                                               testInput, stdin, checkedOutput)
+                except OSError:
+                    pass
+            if status is None:
+                pc.runTest(self.studentCode, testInput, stdin, checkedOutput)
+                status = pc.status()
+        output = status['output']
+        compareStartTime = time.time()
+        if status['syntaxError']:
+            outcome = 'Syntax Error'
+        elif status['outputTruncated']:
+            outcome = 'Output Limit Exceeded'
+        elif status['memoryExceeded']:
+            outcome = 'Memory Limit Exceeded'
+        elif status['timedOut']:
+            outcome = 'Timeout'
+        elif status['outputMismatch']:
+            outcome = 'No'
+        elif status['exception']:
+            outcome = 'Runtime Error'
+        elif self.stripTrailingWs(output) == self.stripTrailingWs(expected):
+            outcome = 'Yes'
+        else:
+            outcome = 'No'  # debug: + ' ' + comparison(output, expected)
+        metrics = None
+        if self.collectMetrics and status['metrics'] is not None:
+            metrics = dict(status['metrics'])
+            metrics['compareTime'] = time.time() - compareStartTime
+            metrics['testTime'] = time.time() - startTime
+        return (outcome, output, {'peakMemory': status['peakMemory'],
+                                  'metrics': metrics})
+
+
+# The per-process state and entry points of the worker processes
+# used by PycodeTester.runTestsParallel.
+
+parallelTester = parallelSnapshot = None
+
+def parallelWorkerInit(tester, snapshot):
+    global parallelTester, parallelSnapshot
+    parallelTester = tester
+    parallelSnapshot = snapshot
+
+
+def parallelWorkerRunTest(test):
+    '''Run a test in a worker, as runTest, turning any exception that
+       would otherwise kill the worker, and leave the pool waiting for
+       its result forever, into a TESTER_FAILED result'''
+    try:
+        return parallelTester.runTest(test, parallelSnapshot, isolated=True)
+    except BaseException, e:
+        return (TESTER_FAILED, '*** Test failed to run: {0!r} ***\n'.format(e),
+                {'peakMemory': None, 'metrics': None})
+
+
 # Utility function to show how two strings differ
 
 def comparison(s1, s2):
@@ -0,0 +1,75 @@
+# Aggregation of the per-submission metrics produced by PycodeTester with
+# metrics=True (see PycodeTester.summariseMetrics), to find out which
+# questions dominate grading cost.
+#
+# Usage:
+#     aggregator = PycodeMetricsAggregator()
+#     for each submission:
+#         tester = PycodeTester(code, metrics=True)
+#         tester.runTests(tests)
+#         aggregator.add(tester.submissionMetrics, questionId)
+#     print json.dumps(aggregator.summary())
+
+
+class PycodeMetricsGroup (object):
+    '''Running totals of the metrics of a set of submissions'''
+    def __init__(self):
+        self.submissions = 0
+        self.cached = 0
+        self.outcomes = {}
+        self.totals = {}
+        self.maxima = {}
+
+
+    def add(self, metrics):
+        self.submissions += 1
+        for (name, value) in metrics.items():
+            if name == 'cached':
+                self.cached += 1 if value else 0
+            elif name == 'outcomes':
+                for (outcome, count) in value.items():
+                    self.outcomes[outcome] = self.outcomes.get(outcome, 0) + count
+            elif isinstance(value, (int, long, float)):
+                self.totals[name] = self.totals.get(name, 0) + value
+                self.maxima[name] = max(self.maxima.get(name, value), value)
+
+
+    def summary(self):
+        '''Return a dictionary of the number of submissions, the number
+           whose results came from the cache, the outcome counts and for
+           each numeric metric its total, mean and maximum per submission'''
+        result = {'submissions': self.submissions,
+                  'cached': self.cached,
+                  'outcomes': dict(self.outcomes)}
+        for (name, total) in self.totals.items():
+            result[name] = {'total': total,
+                            'mean': float(total) / self.submissions,
+                            'max': self.maxima[name]}
+        return result
+
+
+
+class PycodeMetricsAggregator (object):
+    '''Aggregates submission metrics overall and per group (e.g. question)'''
+    def __init__(self):
+        self.overall = PycodeMetricsGroup()
+        self.groups = {}
+
+
+    def add(self, metrics, group=None):
+        '''Add the metrics of one submission, optionally to the given group
+           as well as overall. Metrics of None are ignored.'''
+        if metrics is None:
+            return
+        self.overall.add(metrics)
+        if group is not None:
+            self.groups.setdefault(group, PycodeMetricsGroup()).add(metrics)
+
+
+    def summary(self):
+        '''Return a JSON-serialisable summary of all metrics added so far,
+           as a dictionary with keys 'overall' and 'groups', the latter
+           mapping each group (as a string) to its summary'''
+        return {'overall': self.overall.summary(),
+                'groups': dict((str(group), metricsGroup.summary())
+                               for (group, metricsGroup) in self.groups.items())}
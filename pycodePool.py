@@ -0,0 +1,244 @@
+# A pool of long-lived, pre-started Python worker processes for running
+# pycode tests, so that grading doesn't pay interpreter start-up (and the
+# import of pycodeClasses) on every submission.
+#
+# Each worker reads jobs from its stdin, one JSON line per job of the form
+# [code, testlist] or [code, testlist, options], where options is a
+# dictionary of PycodeTester keyword arguments (e.g. runAll), and writes back one
+# JSON line per job: {"results": [[outcome, output], ...], "recycle": bool},
+# with each output base64-encoded since it needn't be valid UTF-8.
+# Each job is graded in a forked child of the worker, so nothing the student
+# code does (e.g. importing and patching pycodeClasses) can affect later
+# jobs. Where fork is unavailable the job is graded in the worker itself,
+# which then asks to be recycled. The pool also retires each worker after a
+# fixed number of jobs. A worker that doesn't finish a job in time is
+# killed, with any processes it started, and replaced.
+#
+# Workers run student code, so in production they should be started in a
+# sandbox, by giving the pool a command that runs this file with --worker
+# inside it.
+#
+# Usage:
+#     pool = PycodeWorkerPool(4)
+#     results = pool.runTests(code, tests, timeout=30)   # As per PycodeTester.runTests
+#     pool.close()
+#
+# Run this file with the argument --worker to start a single worker.
+
+import base64
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import Queue
+
+from pycodeClasses import KILL_GRACE, TEST_FAILED_MESSAGE, TESTER_FAILED, PycodeTester, readUntil
+
+# Results of jobs the grader failed to grade, as opposed to ones whose tests
+# failed or ran out of time, so that clients don't record or reuse them
+WORKER_FAILED = (TESTER_FAILED, '*** Worker process failed ***\n')
+WORKER_TIMEOUT = (TESTER_FAILED, '*** Worker process took too long ***\n')
+JOB_GRACE = 10.0   # Seconds a job may take beyond its tests' time limits
+
+
+def jobTimeout(tests, options):
+    '''The seconds after which a worker still running the given tests with
+       the given PycodeTester options should be killed: enough for each
+       test, and a snapshot's top level, to run to its wall-clock limit and
+       be killed. None if the options have no wall-clock limit.'''
+    if not options or options.get('wallLimit') is None:
+        return None
+    return (len(tests) + 1) * (options['wallLimit'] + KILL_GRACE) + JOB_GRACE
+
+
+def encodeOutput(output):
+    if isinstance(output, unicode):
+        output = output.encode('utf-8')
+    return base64.b64encode(output)
+
+
+def runJob(code, tests, options):
+    '''Grade a job, returning its results with their outputs encoded'''
+    results = PycodeTester(code, **options).runTests(tests)
+    return [(outcome, encodeOutput(output)) for (outcome, output) in results]
+
+
+def runJobInChild(code, tests, options):
+    '''Grade a job as runJob but in a forked child process, so that the
+       worker is untouched by it. A child that dies without reporting
+       its results gives a runtime error.'''
+    (readFd, writeFd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(readFd)
+            with os.fdopen(writeFd, 'wb') as pipe:
+                pipe.write(json.dumps(runJob(code, tests, options)))
+        finally:
+            os._exit(0)
+
+    os.close(writeFd)
+    try:
+        reply = readUntil(readFd, None)
+    finally:
+        os.close(readFd)
+    os.waitpid(pid, 0)
+    try:
+        return json.loads(reply)
+    except ValueError:
+        return [('Runtime Error', encodeOutput(TEST_FAILED_MESSAGE))]
+
+
+def workerMain():
+    '''The main loop of a worker process'''
+    protocolOut = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    sys.stdout = sys.stderr   # Stray output mustn't corrupt the protocol
+    canFork = hasattr(os, 'fork')
+    line = sys.stdin.readline()
+    while line:
+        job = json.loads(line)
+        (code, tests) = job[:2]
+        options = dict((str(name), value) for (name, value) in job[2].items()) if len(job) > 2 else {}
+        if canFork:
+            results = runJobInChild(code, tests, options)
+        else:
+            results = runJob(code, tests, options)
+        protocolOut.write(json.dumps({'results': results, 'recycle': not canFork}) + '\n')
+        protocolOut.flush()
+        line = sys.stdin.readline()
+
+
+class WorkerTimeout (Exception):
+    '''Raised when a worker doesn't finish a job in time'''
+    pass
+
+
+
+class PycodeWorker (object):
+    '''A single worker subprocess, as seen from the pool'''
+    def __init__(self, command):
+        # In a process group of its own, so it can be killed with its children
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, close_fds=True,
+                                     preexec_fn=getattr(os, 'setsid', None))
+        self.jobsRun = 0
+        self.killed = False
+
+
+    def runJob(self, code, tests, options=None, timeout=None):
+        '''Run the given tests on the given code, with the given dictionary
+           of PycodeTester options. Returns a pair (results, recycle).
+           Raises IOError if the worker has died or, if timeout is not None
+           and the job takes longer than that many seconds, kills the
+           worker and raises WorkerTimeout.
+        '''
+        self.jobsRun += 1
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, self.kill)
+            timer.daemon = True
+            timer.start()
+        try:
+            self.proc.stdin.write(json.dumps([code, tests, options or {}]) + '\n')
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if not line:
+            if self.killed:
+                raise WorkerTimeout('Worker took over {0} seconds'.format(timeout))
+            raise IOError('Worker process terminated')
+        reply = json.loads(line)
+        results = [(str(outcome), base64.b64decode(output))
+                   for (outcome, output) in reply['results']]
+        return (results, reply['recycle'] or self.killed)
+
+
+    def kill(self):
+        self.killed = True
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            else:
+                self.proc.kill()
+        except OSError:
+            pass   # Already exited
+
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait()
+        except (IOError, OSError):
+            pass
+
+
+
+class PycodeWorkerPool (object):
+    '''A fixed-size pool of warm workers. runTests may be called from
+       multiple threads concurrently; each call blocks until a worker
+       is free.'''
+    def __init__(self, size, maxJobs=100, command=None):
+        if command is None:
+            command = [sys.executable, os.path.abspath(__file__), '--worker']
+        self.command = command
+        self.maxJobs = maxJobs
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = []
+        for i in range(size):
+            self.idle.put(self.startWorker())
+
+
+    def startWorker(self):
+        worker = PycodeWorker(self.command)
+        with self.lock:
+            self.workers.append(worker)
+        return worker
+
+
+    def retireWorker(self, worker):
+        with self.lock:
+            self.workers.remove(worker)
+        worker.close()
+
+
+    def runTests(self, code, tests, options=None, timeout=None):
+        '''Run the given tests on the given code in a pooled worker,
+           with the given dictionary of PycodeTester options, returning the
+           same list of (outcome, output) pairs as PycodeTester.runTests.
+           If timeout is not None and the job isn't done in that many
+           seconds, the worker is replaced and the result is WORKER_TIMEOUT.
+        '''
+        worker = self.idle.get()
+        try:
+            (results, recycle) = worker.runJob(code, tests, options, timeout)
+        except WorkerTimeout:
+            (results, recycle) = ([WORKER_TIMEOUT], True)
+        except (IOError, ValueError):
+            (results, recycle) = ([WORKER_FAILED], True)
+        if recycle or worker.jobsRun >= self.maxJobs:
+            self.retireWorker(worker)
+            worker = self.startWorker()
+        self.idle.put(worker)
+        return results
+
+
+    def close(self):
+        with self.lock:
+            workers = list(self.workers)
+            self.workers = []
+        for worker in workers:
+            worker.close()
+
+
+
+if __name__ == '__main__':
+    if '--worker' in sys.argv[1:]:
+        workerMain()
+    else:
+        print >> sys.stderr, "Usage: python pycodePool.py --worker"
+        sys.exit(1)
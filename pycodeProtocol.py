@@ -0,0 +1,230 @@
+# The framed binary protocol between the Moodle question (question.php) and
+# the sandbox front end, with a reference encoder and decoder.
+#
+# Both directions are a byte stream starting with the 4-byte MAGIC, followed
+# by frames. Each frame is a 6-byte header (kind: 1 byte, flags: 1 byte,
+# payload length: 4-byte big-endian unsigned) then the payload, which is
+# zlib-compressed if flags has the FLAG_COMPRESSED bit set. The kinds are:
+#     'S' (spec): a JSON object {"code": <student code>, "tests": <testlist>,
+#                 "compress": <bool>, "user": <user id>,
+#                 "priority": <class>, "disallowedImports": <list>,
+#                 "disallowedCalls": <list>, "runAll": <bool>,
+#                 "fixtureDir": <path>, "failFast": <bool>,
+#                 "cpuLimit": <secs>, "wallLimit": <secs>,
+#                 "memLimit": <bytes>}, testlist as for
+#                 PycodeTester.runTests, compress true if large result frames
+#                 may be compressed, the optional user and priority class
+#                 telling the grading server whose request it is and how
+#                 urgent (see pycodeServer.py) and the optional lists of
+#                 imports and calls the question forbids (see screenCode in
+#                 pycodeClasses.py), runAll true to carry on testing after
+#                 errors other than syntax errors, fixtureDir the optional
+#                 directory of the question's read-only data files and
+#                 failFast true to stop at the first failing test and the
+#                 optional per-test time and memory limits (see
+#                 PycodeTester);
+#     'R' (result): one per test run, in order, the outcome (ASCII), a NUL
+#                   byte, then the test's output as raw bytes;
+#     'E' (end): an empty frame ending the results, so that a truncated
+#                result stream can be detected;
+#     'B' (busy): sent instead of results by a grading server that can't
+#                 accept the request, with a message as payload.
+# The request stream is MAGIC plus a single spec frame, written to the front
+# end's stdin; the reply is MAGIC, the result frames and an end frame on its
+# stdout. Anything before the reply's MAGIC (e.g. messages from the sandbox
+# controller) is ignored.
+#
+# Unlike the original protocol (base64 JSON as a command line argument,
+# outcomes and hex-encoded outputs on alternating lines of stdout), output
+# isn't doubled in size and the test set isn't limited by the maximum
+# command line length. The original protocol is still served, for old
+# clients, when a command line argument is given.
+#
+# Usage, as the sandbox front end:
+#     python pycodeProtocol.py < request > reply
+#     python pycodeProtocol.py <base64 JSON [code, testlist]>   # Original protocol
+
+import base64
+import json
+import struct
+import sys
+import zlib
+
+from pycodeClasses import PycodeTester
+
+MAGIC = 'PYC1'
+FRAME_HEADER = struct.Struct('>cBI')
+FLAG_COMPRESSED = 0x01
+COMPRESS_THRESHOLD = 1024   # Payloads shorter than this are never compressed
+KIND_SPEC = 'S'
+KIND_RESULT = 'R'
+KIND_END = 'E'
+KIND_BUSY = 'B'
+PRIORITY_CLASSES = ('interactive', 'quizfinish', 'regrade', 'validation')  # Highest first
+
+
+class ProtocolError (Exception):
+    '''Raised when a stream doesn't conform to the protocol'''
+    pass
+
+
+class ServerBusy (ProtocolError):
+    '''Raised when decoding a reply from a grading server that was too
+       busy to accept the request'''
+    pass
+
+
+def encodeFrame(kind, payload, compress=False):
+    '''Return the frame of the given kind with the given payload, which is
+       compressed if compress is True and compression makes it smaller'''
+    flags = 0
+    if compress and len(payload) >= COMPRESS_THRESHOLD:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= FLAG_COMPRESSED
+    return FRAME_HEADER.pack(kind, flags, len(payload)) + payload
+
+
+def decodePayload(flags, payload):
+    if flags & FLAG_COMPRESSED:
+        try:
+            return zlib.decompress(payload)
+        except zlib.error, e:
+            raise ProtocolError('Bad compressed payload: {0}'.format(e))
+    return payload
+
+
+def readExactly(stream, n):
+    '''Read exactly n bytes from stream, or raise ProtocolError'''
+    chunks = []
+    while n > 0:
+        chunk = stream.read(n)
+        if not chunk:
+            raise ProtocolError('Unexpected end of stream')
+        chunks.append(chunk)
+        n -= len(chunk)
+    return ''.join(chunks)
+
+
+def readFrame(stream):
+    '''Read the next frame from stream, returning a (kind, payload) pair'''
+    (kind, flags, length) = FRAME_HEADER.unpack(readExactly(stream, FRAME_HEADER.size))
+    return (kind, decodePayload(flags, readExactly(stream, length)))
+
+
+def decodeFrames(data, start=0):
+    '''Generate the (kind, payload) pairs of the frames in the string data,
+       starting at offset start'''
+    pos = start
+    while pos < len(data):
+        if pos + FRAME_HEADER.size > len(data):
+            raise ProtocolError('Truncated frame header')
+        (kind, flags, length) = FRAME_HEADER.unpack_from(data, pos)
+        pos += FRAME_HEADER.size
+        if pos + length > len(data):
+            raise ProtocolError('Truncated frame')
+        yield (kind, decodePayload(flags, data[pos:pos + length]))
+        pos += length
+
+
+def encodeRequest(code, tests, compress=False, user=None, priority=None, options=None):
+    '''Return the request stream for running tests on code. If compress
+       is True, the spec is compressed and compressed results are allowed.
+       options is a dictionary of any further spec fields, e.g. runAll.'''
+    spec = dict(options or {})
+    spec.update({'code': code, 'tests': tests, 'compress': compress})
+    if user is not None:
+        spec['user'] = user
+    if priority is not None:
+        spec['priority'] = priority
+    return MAGIC + encodeFrame(KIND_SPEC, json.dumps(spec), compress)
+
+
+def readRequest(stream):
+    '''Read a request from stream, returning its spec as a dictionary
+       with at least the keys 'code', 'tests' and 'compress' '''
+    if readExactly(stream, len(MAGIC)) != MAGIC:
+        raise ProtocolError('Bad magic number')
+    (kind, payload) = readFrame(stream)
+    if kind != KIND_SPEC:
+        raise ProtocolError('Expected a spec frame, got {0!r}'.format(kind))
+    try:
+        spec = json.loads(payload)
+        if not isinstance(spec, dict) or 'code' not in spec or 'tests' not in spec:
+            raise ValueError('code and tests are required')
+    except ValueError, e:
+        raise ProtocolError('Bad spec: {0}'.format(e))
+    spec.setdefault('compress', False)
+    return spec
+
+
+def encodeResult(outcome, output, compress=False):
+    '''Return the result frame for one test'''
+    if isinstance(output, unicode):
+        output = output.encode('utf-8')
+    return encodeFrame(KIND_RESULT, str(outcome) + '\0' + output, compress)
+
+
+def writeReply(stream, results, compress=False):
+    '''Write the reply stream for the given list of (outcome, output) pairs'''
+    stream.write(MAGIC)
+    for (outcome, output) in results:
+        stream.write(encodeResult(outcome, output, compress))
+    stream.write(encodeFrame(KIND_END, ''))
+    stream.flush()
+
+
+def decodeReply(data):
+    '''Return the list of (outcome, output) pairs in a reply stream,
+       ignoring anything before the magic number. Raises ServerBusy if
+       the request was refused and ProtocolError if the reply is missing
+       or incomplete.'''
+    start = data.find(MAGIC)
+    if start < 0:
+        raise ProtocolError('No reply')
+    results = []
+    for (kind, payload) in decodeFrames(data, start + len(MAGIC)):
+        if kind == KIND_END:
+            return results
+        elif kind == KIND_RESULT:
+            (outcome, sep, output) = payload.partition('\0')
+            results.append((outcome, output))
+        elif kind == KIND_BUSY:
+            raise ServerBusy(payload)
+        else:
+            raise ProtocolError('Unexpected frame kind {0!r}'.format(kind))
+    raise ProtocolError('Reply has no end frame')
+
+
+def serveFramed(instream, outstream):
+    '''Serve one framed request from instream, replying on outstream'''
+    spec = readRequest(instream)
+    tester = PycodeTester(spec['code'], disallowedImports=spec.get('disallowedImports'),
+                          disallowedCalls=spec.get('disallowedCalls'),
+                          runAll=spec.get('runAll', False),
+                          fixtureDir=spec.get('fixtureDir'),
+                          failFast=spec.get('failFast', False),
+                          cpuLimit=spec.get('cpuLimit'), wallLimit=spec.get('wallLimit'),
+                          memLimit=spec.get('memLimit'))
+    results = tester.runTests(spec['tests'])
+    writeReply(outstream, results, spec['compress'])
+
+
+def serveOriginal(encodedSpec, outstream):
+    '''Serve a request in the original protocol: encodedSpec is base64
+       JSON [code, testlist] and each result is written to outstream as
+       an outcome line then a line of the output in hex'''
+    (code, tests) = json.loads(base64.b64decode(encodedSpec))
+    for (outcome, output) in PycodeTester(code).runTests(tests):
+        if isinstance(output, unicode):
+            output = output.encode('utf-8')
+        outstream.write(outcome + '\n' + output.encode('hex') + '\n')
+    outstream.flush()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        serveOriginal(sys.argv[1], sys.stdout)
+    else:
+        serveFramed(sys.stdin, sys.stdout)
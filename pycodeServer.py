@@ -0,0 +1,446 @@
+# A local grading server, so that a burst of submissions is queued and
+# graded at a steady rate rather than each web request starting its own
+# sandbox process.
+#
+# The server listens on a Unix socket. Each connection carries a single
+# request and reply in the framed protocol of pycodeProtocol.py. Requests
+# are graded by a PycodeWorkerPool (see pycodePool.py) with, by default, one
+# worker per core. Requests that find all workers busy wait in a queue which
+# is served fairly between users: each user with waiting requests gets one
+# graded in turn, so one user's many submissions can't hold up everyone
+# else's. When the queue is full (in total or for the request's user) the
+# request is refused at once with a busy frame, which the client can report
+# or retry later, as is a request still waiting after --max-queue-wait
+# seconds. A client should therefore wait that long for a reply, plus the
+# time the job may take once started (see jobTimeout in pycodePool.py).
+#
+# Every job is graded with time and memory limits per test: those asked for
+# in the spec (cpuLimit, wallLimit, memLimit), but no more than the server's
+# own limits, which are also the defaults. A worker that still hasn't
+# finished a job well after its tests' time limits is killed and replaced.
+# The workers run student code, so --pool-command should start them in a
+# sandbox, e.g. the pypy sandbox running pycodePool.py --worker.
+#
+# Submissions are screened for disallowed imports and calls (see screenCode
+# in pycodeClasses.py) by the worker that grades them, as compiling
+# untrusted code can crash the process that does it.
+#
+# Each request has a priority class, given by the optional "priority" field
+# of its spec: 'interactive' (the default; a student waiting for feedback),
+# 'quizfinish', 'regrade' or 'validation' (question authoring), in order of
+# decreasing priority. A free worker always takes a job of the highest class
+# waiting. Jobs aren't preempted, but the background classes (regrade and
+# validation) are kept off at least one worker by default when there are
+# two or more, so interactive work never waits behind more than a single
+# job. A server with a single worker can't reserve it: background jobs may
+# run on it, or they would never run at all. Each class has its own
+# queue limits, so a big regrade backlog doesn't make the server busy for
+# students.
+#
+# With --cache-dir, results are cached (see pycodeCache.py) in the given
+# directory and a request whose results are there is answered at once,
+# without queueing. Results with a timeout or a grader failure aren't
+# cached, as they depend on load.
+#
+# With --broker, jobs aren't graded locally but published to the given
+# broker directory, to be graded by grader nodes on other hosts (see
+# pycodeBroker.py), and --workers is the number of jobs to have
+# outstanding with the broker at once. A job no node has graded within
+# BROKER_WAIT seconds plus its time limits is withdrawn and the client gets
+# a busy frame, as it does when the server shuts down with jobs queued.
+#
+# Usage: python pycodeServer.py [--socket PATH] [--workers N]
+#                               [--max-queued N] [--max-queued-per-user N]
+#                               [--max-background N] [--broker DIR]
+#                               [--pool-command COMMAND] [--cpu-limit SECS]
+#                               [--wall-limit SECS] [--mem-limit MB]
+#                               [--cache-dir DIR] [--max-queue-wait SECS]
+#
+# Clients can use gradeViaServer, e.g.
+#     results = gradeViaServer('/tmp/pycode.sock', code, tests, user='fred',
+#                              priority='regrade')
+
+import argparse
+import collections
+import multiprocessing
+import os
+import shlex
+import socket
+import SocketServer
+import sys
+import threading
+
+from pycodeBroker import BrokerTimeout, PycodeFileBroker, gradeViaBroker
+from pycodeCache import PycodeResultCache
+from pycodeClasses import TESTER_FAILED, fixtureSignature
+from pycodePool import PycodeWorkerPool, WORKER_FAILED, jobTimeout
+from pycodeProtocol import (MAGIC, KIND_BUSY, PRIORITY_CLASSES, ProtocolError, decodeReply,
+                            encodeFrame, encodeRequest, readRequest, writeReply)
+
+DEFAULT_SOCKET = '/tmp/pycode.sock'
+BACKGROUND_CLASSES = ('regrade', 'validation')
+DEFAULT_CPU_LIMIT = 5.0           # Seconds of CPU time per test
+DEFAULT_WALL_LIMIT = 10.0         # Seconds of elapsed time per test
+DEFAULT_MEM_LIMIT = 256 * 2**20   # Bytes of extra memory per test
+BROKER_WAIT = 60.0                # Seconds a brokered job may wait for a node
+MAX_QUEUE_WAIT = 60.0             # Seconds a request may wait to start grading
+
+
+class PycodeJob (object):
+    '''A request waiting to be graded'''
+    def __init__(self, user, code, tests, priority='interactive', options=None):
+        self.user = user
+        self.priority = priority
+        self.code = code
+        self.tests = tests
+        self.options = options   # PycodeTester options
+        self.results = None
+        self.finished = threading.Event()
+
+
+    def finish(self, results):
+        '''Record the job's results, or None if it couldn't be graded'''
+        self.results = results
+        self.finished.set()
+
+
+    def wait(self):
+        '''Wait until the job is graded and return its results, or None if
+           it couldn't be graded and the client should try again later'''
+        self.finished.wait()
+        return self.results
+
+
+
+class PycodeScheduler (object):
+    '''Queues of jobs, one per priority class, each served round-robin
+       between users. Jobs are handed out highest class first, except that
+       at most maxBackground (if not None) jobs of the BACKGROUND_CLASSES
+       may be running at once. At most maxQueued jobs of each class may be
+       waiting and, if maxQueuedPerUser is not None, at most that many of
+       each class for any one user.'''
+    def __init__(self, maxQueued=100, maxQueuedPerUser=None, maxBackground=None):
+        self.maxQueued = maxQueued
+        self.maxQueuedPerUser = maxQueuedPerUser
+        self.maxBackground = maxBackground
+        # For each class, user -> deque of jobs, in turn order
+        self.queues = dict((priority, collections.OrderedDict()) for priority in PRIORITY_CLASSES)
+        self.queued = dict((priority, 0) for priority in PRIORITY_CLASSES)
+        self.runningBackground = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+
+    def submit(self, job):
+        '''Queue the given job, returning False if its class's queue is full'''
+        with self.condition:
+            queues = self.queues[job.priority]
+            userQueue = queues.get(job.user)
+            if (self.closed or self.queued[job.priority] >= self.maxQueued or
+                    (userQueue is not None and self.maxQueuedPerUser is not None
+                     and len(userQueue) >= self.maxQueuedPerUser)):
+                return False
+            if userQueue is None:
+                userQueue = queues[job.user] = collections.deque()
+            userQueue.append(job)
+            self.queued[job.priority] += 1
+            self.condition.notify()
+            return True
+
+
+    def next(self):
+        '''Wait for and return the next job to grade, or None once the
+           scheduler has been closed. The caller must call done(job)
+           when the job has been graded.'''
+        with self.condition:
+            job = None
+            while job is None and not self.closed:
+                job = self.takeJob()
+                if job is None:
+                    self.condition.wait()
+            return job
+
+
+    def takeJob(self):
+        '''Remove and return the next job that may run now, or None.
+           Caller must hold the lock.'''
+        for priority in PRIORITY_CLASSES:
+            queues = self.queues[priority]
+            background = priority in BACKGROUND_CLASSES
+            if not queues or (background and self.maxBackground is not None
+                              and self.runningBackground >= self.maxBackground):
+                continue
+            (user, userQueue) = queues.popitem(last=False)
+            job = userQueue.popleft()
+            if userQueue:
+                queues[user] = userQueue   # To the back of the line
+            self.queued[priority] -= 1
+            if background:
+                self.runningBackground += 1
+            return job
+        return None
+
+
+    def withdraw(self, job):
+        '''Remove the given job if it's still queued, returning True if
+           it was'''
+        with self.condition:
+            queues = self.queues[job.priority]
+            userQueue = queues.get(job.user)
+            if userQueue is None or job not in userQueue:
+                return False
+            userQueue.remove(job)
+            if not userQueue:
+                del queues[job.user]
+            self.queued[job.priority] -= 1
+            return True
+
+
+    def done(self, job):
+        '''Record that the given job, from next, has been graded'''
+        with self.condition:
+            if job.priority in BACKGROUND_CLASSES:
+                self.runningBackground -= 1
+                self.condition.notify()   # A waiting background job may now run
+
+
+    def close(self):
+        '''Stop handing out jobs. Jobs still queued are finished with None,
+           so their clients are told the server is busy.'''
+        with self.condition:
+            self.closed = True
+            abandoned = [job for queues in self.queues.values()
+                         for userQueue in queues.values() for job in userQueue]
+            for queues in self.queues.values():
+                queues.clear()
+            self.queued = dict((priority, 0) for priority in PRIORITY_CLASSES)
+            self.condition.notify_all()
+        for job in abandoned:
+            job.finish(None)
+
+
+
+class PycodeRequestHandler (SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            spec = readRequest(self.rfile)
+        except ProtocolError, e:
+            self.server.log('Bad request: {0}'.format(e))
+            return
+        priority = spec.get('priority', 'interactive')
+        if priority not in PRIORITY_CLASSES:
+            self.server.log('Bad request: unknown priority {0!r}'.format(priority))
+            return
+        options = {'runAll': bool(spec.get('runAll', False)),
+                   'failFast': bool(spec.get('failFast', False))}
+        for name in ('disallowedImports', 'disallowedCalls'):
+            if spec.get(name):
+                options[name] = spec[name]
+        options.update(self.server.limits(spec))
+        if spec.get('fixtureDir') is not None:
+            options['fixtureDir'] = spec['fixtureDir']
+        key = self.server.cacheKey(spec['code'], spec['tests'], options)
+        results = self.server.cache.get(key) if key is not None else None
+        try:
+            if results is not None:
+                writeReply(self.wfile, results, spec['compress'])
+                return
+            job = PycodeJob(spec.get('user'), spec['code'], spec['tests'], priority, options)
+            if not self.server.scheduler.submit(job):
+                self.wfile.write(MAGIC + encodeFrame(KIND_BUSY, 'Grading server busy'))
+                return
+            if (not job.finished.wait(self.server.maxQueueWait) and
+                    self.server.scheduler.withdraw(job)):
+                results = None   # Not started in time
+            else:
+                results = job.wait()
+            if results is None:
+                self.wfile.write(MAGIC + encodeFrame(KIND_BUSY, 'Grading server busy'))
+                return
+            outcomes = [outcome for (outcome, output) in results]
+            if key is not None and 'Timeout' not in outcomes and TESTER_FAILED not in outcomes:
+                self.server.cache.put(key, results)
+            writeReply(self.wfile, results, spec['compress'])
+        except socket.error:
+            pass   # Client gave up waiting
+
+
+
+class PycodeServer (SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''The grading server. Each connection is handled in its own thread,
+       which waits for its job to be graded by one of the dispatcher
+       threads, each of which feeds a single pool worker or, if the
+       server has a broker, has a single job graded via the broker.'''
+    daemon_threads = True
+
+    def __init__(self, path=DEFAULT_SOCKET, workers=None, maxQueued=100,
+                 maxQueuedPerUser=None, poolCommand=None, maxBackground=None,
+                 broker=None, cpuLimit=DEFAULT_CPU_LIMIT, wallLimit=DEFAULT_WALL_LIMIT,
+                 memLimit=DEFAULT_MEM_LIMIT, cache=None, maxQueueWait=MAX_QUEUE_WAIT):
+        '''Construct a server with the given number of workers (default one
+           per core), at most maxBackground (default all but one of them,
+           or the only one) running background jobs at once. See PycodeScheduler for the
+           queue limits. The pool's workers are started with poolCommand
+           (see PycodeWorkerPool). If broker is not None, jobs are graded
+           via that PycodeBroker rather than by a local pool. cpuLimit,
+           wallLimit and memLimit are the most, and the default, CPU
+           seconds, elapsed seconds and bytes of memory any test may use.
+           If cache is not None, it's a PycodeResultCache used to answer
+           requests without grading them where possible. A request not
+           started within maxQueueWait seconds (if not None) is withdrawn
+           and refused as busy.'''
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if maxBackground is None:
+            maxBackground = max(1, workers - 1)
+        if os.path.exists(path):
+            os.remove(path)   # Left by a previous server
+        SocketServer.UnixStreamServer.__init__(self, path, PycodeRequestHandler)
+        self.path = path
+        self.broker = broker
+        self.cache = cache
+        self.maxQueueWait = maxQueueWait
+        self.maxLimits = {'cpuLimit': cpuLimit, 'wallLimit': wallLimit, 'memLimit': memLimit}
+        self.pool = PycodeWorkerPool(workers, command=poolCommand) if broker is None else None
+        self.scheduler = PycodeScheduler(maxQueued, maxQueuedPerUser, maxBackground)
+        self.dispatchers = []
+        for i in range(workers):
+            dispatcher = threading.Thread(target=self.dispatch)
+            dispatcher.daemon = True
+            dispatcher.start()
+            self.dispatchers.append(dispatcher)
+
+
+    def limits(self, spec):
+        '''Return the dictionary of PycodeTester limit options for a request
+           with the given spec: the limits it asks for, but no more than
+           the server's'''
+        limits = {}
+        for (name, maxLimit) in self.maxLimits.items():
+            limit = spec.get(name)
+            if not isinstance(limit, (int, long, float)) or limit <= 0 or limit > maxLimit:
+                limit = maxLimit
+            limits[name] = limit
+        return limits
+
+
+    def cacheKey(self, code, tests, options):
+        '''The cache key for a job with the given code, tests and
+           PycodeTester options, or None if there's no cache. It covers
+           the contents of any fixture directory, via its signature.'''
+        if self.cache is None:
+            return None
+        keyOptions = dict(options)
+        if options.get('fixtureDir') is not None:
+            keyOptions['fixtures'] = fixtureSignature(options['fixtureDir'])
+        return self.cache.key(code, tests, keyOptions)
+
+
+    def dispatch(self):
+        '''The main loop of a dispatcher thread'''
+        job = self.scheduler.next()
+        while job is not None:
+            try:
+                if self.broker is not None:
+                    timeout = BROKER_WAIT + (jobTimeout(job.tests, job.options) or 0)
+                    results = gradeViaBroker(self.broker, job.code, job.tests,
+                                             job.options, job.priority, timeout)
+                else:
+                    results = self.pool.runTests(job.code, job.tests, job.options,
+                                                 jobTimeout(job.tests, job.options))
+            except BrokerTimeout, e:
+                self.log(str(e))
+                results = None
+            except Exception, e:
+                self.log('Grading failed: {0}'.format(e))
+                results = [WORKER_FAILED]
+            self.scheduler.done(job)
+            job.finish(results)
+            job = self.scheduler.next()
+
+
+    def log(self, message):
+        print >> sys.stderr, message
+
+
+    def server_close(self):
+        self.scheduler.close()
+        SocketServer.UnixStreamServer.server_close(self)
+        if self.pool is not None:
+            self.pool.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+
+def gradeViaServer(path, code, tests, user=None, compress=False, priority=None,
+                   options=None):
+    '''Grade the given code and tests with the server listening on the
+       given socket, returning a list of (outcome, output) pairs as for
+       PycodeTester.runTests. options is a dictionary of further spec
+       fields (see pycodeProtocol.py). Raises ServerBusy if the server
+       refuses the request.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(encodeRequest(code, tests, compress, user, priority, options))
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        chunk = sock.recv(65536)
+        while chunk:
+            chunks.append(chunk)
+            chunk = sock.recv(65536)
+    finally:
+        sock.close()
+    return decodeReply(''.join(chunks))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a pycode grading server')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help='path of the Unix socket (default {0})'.format(DEFAULT_SOCKET))
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of grading workers (default one per core)')
+    parser.add_argument('--max-queued', type=int, default=100,
+                        help='most requests that may wait to be graded (default 100)')
+    parser.add_argument('--max-queued-per-user', type=int, default=None,
+                        help='most requests that may wait for any one user')
+    parser.add_argument('--max-background', type=int, default=None,
+                        help='most regrade and validation requests graded at once '
+                             '(default all workers but one, or the only one)')
+    parser.add_argument('--broker', metavar='DIR', default=None,
+                        help='grade via the file broker in DIR (see pycodeBroker.py)')
+    parser.add_argument('--pool-command', metavar='COMMAND', default=None,
+                        help='command that starts a sandboxed grading worker, '
+                             'e.g. running pycodePool.py --worker in the pypy sandbox')
+    parser.add_argument('--cpu-limit', type=float, default=DEFAULT_CPU_LIMIT,
+                        help='most CPU seconds per test (default {0})'.format(DEFAULT_CPU_LIMIT))
+    parser.add_argument('--wall-limit', type=float, default=DEFAULT_WALL_LIMIT,
+                        help='most elapsed seconds per test (default {0})'.format(DEFAULT_WALL_LIMIT))
+    parser.add_argument('--mem-limit', type=int, default=DEFAULT_MEM_LIMIT // 2**20,
+                        help='most MB of memory per test (default {0})'.format(DEFAULT_MEM_LIMIT // 2**20))
+    parser.add_argument('--cache-dir', metavar='DIR', default=None,
+                        help='cache results in DIR (see pycodeCache.py)')
+    parser.add_argument('--max-queue-wait', type=float, default=MAX_QUEUE_WAIT,
+                        help='most seconds a request may wait to start grading before it is '
+                             'refused as busy (default {0})'.format(MAX_QUEUE_WAIT))
+    args = parser.parse_args()
+    broker = PycodeFileBroker(args.broker) if args.broker else None
+    cache = PycodeResultCache(directory=args.cache_dir) if args.cache_dir else None
+    poolCommand = shlex.split(args.pool_command) if args.pool_command else None
+    if poolCommand is None and broker is None:
+        print >> sys.stderr, 'Warning: workers run student code unsandboxed (see --pool-command)'
+    server = PycodeServer(args.socket, args.workers, args.max_queued,
+                          args.max_queued_per_user, poolCommand, args.max_background,
+                          broker, args.cpu_limit, args.wall_limit, args.mem_limit * 2**20,
+                          cache, args.max_queue_wait)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
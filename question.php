@@ -31,6 +31,61 @@ $SANDBOX = "/usr/local/pypy-sandbox-4-pycode/pypy/translator/sandbox/pycodeTest.
 
 $GLOBALS['SANDBOX'] = $SANDBOX; // So it works in any context
 
+// The protocol spoken by the sandbox front end: 'original' (the test set as
+// a base64 command line argument, hex-encoded results on stdout) or
+// 'framed' (see pycodeProtocol.py), which has no limit on the size of the
+// test set and is needed for RUN_ALL_TESTS, FAIL_FAST_PRIORITIES and
+// FIXTURE_ROOT. Only use 'framed' if the front end is pycodeProtocol.py or
+// otherwise supports it. The grading server always uses 'framed'.
+$SANDBOX_PROTOCOL = 'original';
+//$SANDBOX_PROTOCOL = 'framed';
+
+$GLOBALS['SANDBOX_PROTOCOL'] = $SANDBOX_PROTOCOL;
+
+// If set, the Unix socket of a grading server (see pycodeServer.py) to
+// use instead of running the sandbox directly.
+$GRADER_SOCKET = null;
+//$GRADER_SOCKET = "/tmp/pycode.sock";
+
+$GLOBALS['GRADER_SOCKET'] = $GRADER_SOCKET;
+
+// How long to wait for the grading server's reply: GRADER_QUEUE_WAIT
+// seconds, which must be at least its --max-queue-wait (plus BROKER_WAIT in
+// pycodeServer.py if it grades via a broker), plus the time the job may take
+// once started with tests limited to GRADER_WALL_LIMIT seconds, its
+// --wall-limit (see jobTimeout in pycodePool.py).
+$GRADER_QUEUE_WAIT = 60;
+$GRADER_WALL_LIMIT = 10;
+
+$GLOBALS['GRADER_QUEUE_WAIT'] = $GRADER_QUEUE_WAIT;
+$GLOBALS['GRADER_WALL_LIMIT'] = $GRADER_WALL_LIMIT;
+
+// If true, testing carries on after runtime errors (though not syntax
+// errors) so students see all their failures in a single submission.
+$RUN_ALL_TESTS = false;
+
+$GLOBALS['RUN_ALL_TESTS'] = $RUN_ALL_TESTS;
+
+// The grading priority classes (see grading_priority in progcode/question.php)
+// in which only the verdict is needed, not feedback on every test. In these
+// testing stops at the first failure, running the tests most likely to fail
+// first, and students see only the tests run. The likelihoods come from the
+// run and failure counts of each testcase, which every interactive or
+// quiz-finish grading updates, whether or not COMPUTE_STATS is set.
+$FAIL_FAST_PRIORITIES = array();
+//$FAIL_FAST_PRIORITIES = array('regrade', 'quizfinish');
+
+$GLOBALS['FAIL_FAST_PRIORITIES'] = $FAIL_FAST_PRIORITIES;
+
+// If set, a directory of per-question data files: the files in its
+// subdirectory named by a question's id can be read (but not written) by
+// the student code, and are memory-mapped by the tester rather than being
+// sent with each request. Must be visible to the sandbox or grading server.
+$FIXTURE_ROOT = null;
+//$FIXTURE_ROOT = "/usr/local/pycode-fixtures";
+
+$GLOBALS['FIXTURE_ROOT'] = $FIXTURE_ROOT;
+
 require_once($CFG->dirroot . '/question/type/pycode/progcode/question.php');
 
 /**
@@ -40,10 +95,12 @@ class qtype_pycode_question extends qtype_progcode_question {
 
     // Check the correctness of a student's Python code given the
     // response and and a set of testCases.
-    // Return value is an array of test-result objects, each have just an
-    // isCorrect field and an output field (the actual output).
-    // If an error occurs, all further tests are aborted so the returned array may be shorter
-    // than the input array
+    // Return value is an array of test-result objects, each with an
+    // isCorrect field, an outcome field (e.g. 'Yes', 'No', 'Runtime Error')
+    // and an output field (the actual output).
+    // If an error occurs, all further tests are aborted (unless RUN_ALL_TESTS
+    // is set and the error isn't a syntax error) so the returned array may
+    // be shorter than the input array
     protected function run_tests($code, $testcases) {
         global $SANDBOX;
     	$testlist = array();
@@ -57,36 +114,69 @@ class qtype_pycode_question extends qtype_progcode_question {
             }
         }
 
-        $testsetjson = json_encode(array($code, $testlist));
-    	$testsetencoded = base64_encode($testsetjson);
-        $cmd = "{$GLOBALS['SANDBOX']} \"$testsetencoded\"";
-    	$lines = array();
-
-    	try {
-            exec("$cmd", $lines);
-    	}
-    	catch (Exception $e) {
-            $err = $e->getMessage();
-            debugging("Exception $err on calling sandboxed pypy");
-    	}
-
-        while (count($lines) > 0 && substr($lines[0], 0, 1) == '[') {
-            // Filter out any error messages from the sandbox, such as
-            // [sandlib: timeout]
-            array_shift($lines);
+        // Send the tests to the grading server, if there is one, or else
+        // to the sandbox front end, in the framed protocol described in
+        // pycodeProtocol.py or the original protocol (see SANDBOX_PROTOCOL).
+        $compress = function_exists('gzuncompress');
+        $options = array();
+        if ($this->fail_fast()) {
+            $options['failFast'] = true;
+        }
+        else if ($GLOBALS['RUN_ALL_TESTS']) {
+            $options['runAll'] = true;
+        }
+        if ($GLOBALS['FIXTURE_ROOT'] !== null && is_dir($GLOBALS['FIXTURE_ROOT'] . '/' . $this->id)) {
+            $options['fixtureDir'] = $GLOBALS['FIXTURE_ROOT'] . '/' . $this->id;
+        }
+        $reply = '';
+        if ($GLOBALS['GRADER_SOCKET'] !== null) {
+            global $USER;
+            $user = isset($USER->id) ? $USER->id : null;
+            $request = encodeRequest($code, $testlist, $compress, $user,
+                    $this->grading_priority(), $options);
+            $socket = stream_socket_client('unix://' . $GLOBALS['GRADER_SOCKET'], $errno, $errstr);
+            if ($socket) {
+                stream_set_timeout($socket, graderTimeout(count($testlist)));
+                fwrite($socket, $request);
+                stream_socket_shutdown($socket, STREAM_SHUT_WR);
+                $reply = stream_get_contents($socket);
+                fclose($socket);
+            }
+            else {
+                debugging("Failed to connect to grading server: $errstr");
+            }
+            $results = decodeReply($reply);
+        }
+        else if ($GLOBALS['SANDBOX_PROTOCOL'] == 'framed') {
+            $request = encodeRequest($code, $testlist, $compress, null, null, $options);
+            $descriptors = array(0 => array('pipe', 'r'), 1 => array('pipe', 'w'));
+            $process = proc_open($GLOBALS['SANDBOX'], $descriptors, $pipes);
+            if (is_resource($process)) {
+                fwrite($pipes[0], $request);
+                fclose($pipes[0]);
+                $reply = stream_get_contents($pipes[1]);
+                fclose($pipes[1]);
+                proc_close($process);
+            }
+            else {
+                debugging("Failed to start sandboxed pypy");
+            }
+            $results = decodeReply($reply);
+        }
+        else {
+            $results = runSandboxOriginal($code, $testlist);
         }
 
-    	if (count($lines) == 0) {
-            $lines = array('Tester failed', '*** SYSTEM ERROR ***');
-    	}
+        if ($results === null || count($results) == 0) {
+            $results = array(array('Tester failed', '*** SYSTEM ERROR ***'));
+        }
 
     	$testResults = array();
-
-    	for ($i = 0; $i < count($lines) - 1; $i += 2) {
-            $outcome = $lines[$i];
-            $output = decodeHex($lines[$i + 1]);
+        foreach ($results as $result) {
+            list($outcome, $output) = $result;
             $testresult = new stdClass;
-            $testresult->isCorrect = $lines[$i] == 'Yes';
+            $testresult->isCorrect = $outcome == 'Yes';
+            $testresult->outcome = $outcome;
             $testresult->output = $output;
             $testResults[] = $testresult;
     	}
@@ -94,13 +184,153 @@ class qtype_pycode_question extends qtype_progcode_question {
     	return $testResults;
     }
 
+
+    // Unless RUN_ALL_TESTS is set, testing stops at any error.
+    protected function stops_testing($outcome) {
+        if ($GLOBALS['RUN_ALL_TESTS'] && !$this->fail_fast()) {
+            return $outcome == 'Syntax Error';
+        }
+        return parent::stops_testing($outcome);
+    }
+
+
+    protected function fail_fast() {
+        return in_array($this->grading_priority(), $GLOBALS['FAIL_FAST_PRIORITIES']);
+    }
+
 }
 
 // *** Utility functions ***
+
+// The most seconds the grading server may take to reply to a request with
+// the given number of tests (see GRADER_QUEUE_WAIT). Mirrors jobTimeout
+// in pycodePool.py.
+function graderTimeout($numtests) {
+    $killgrace = 2;   // KILL_GRACE in pycodeClasses.py
+    $jobgrace = 10;   // JOB_GRACE in pycodePool.py
+    return $GLOBALS['GRADER_QUEUE_WAIT'] +
+            ($numtests + 1) * ($GLOBALS['GRADER_WALL_LIMIT'] + $killgrace) + $jobgrace;
+}
+
+// Run the given list of tests on $code in the sandbox using the original
+// protocol: the test set is passed as a base64 command line argument and
+// the results come back as outcomes and hex-encoded outputs on alternating
+// lines. Returns the array of (outcome, output) pairs, which is empty if
+// the sandbox failed.
+function runSandboxOriginal($code, $testlist) {
+    $testsetjson = json_encode(array($code, $testlist));
+    $testsetencoded = base64_encode($testsetjson);
+    $cmd = "{$GLOBALS['SANDBOX']} \"$testsetencoded\"";
+    $lines = array();
+
+    try {
+        exec("$cmd", $lines);
+    }
+    catch (Exception $e) {
+        $err = $e->getMessage();
+        debugging("Exception $err on calling sandboxed pypy");
+    }
+
+    while (count($lines) > 0 && substr($lines[0], 0, 1) == '[') {
+        // Filter out any error messages from the sandbox, such as
+        // [sandlib: timeout]
+        array_shift($lines);
+    }
+
+    $results = array();
+    for ($i = 0; $i < count($lines) - 1; $i += 2) {
+        $results[] = array($lines[$i], decodeHex($lines[$i + 1]));
+    }
+    return $results;
+}
+
+
 function decodeHex($hex){
     $string='';
     for ($i=0; $i < strlen($hex)-1; $i+=2){
         $string .= chr(hexdec($hex[$i].$hex[$i+1]));
     }
     return $string;
-}
\ No newline at end of file
+}
+
+
+// Encoding and decoding of the framed protocol. See pycodeProtocol.py.
+
+define('PYCODE_MAGIC', 'PYC1');
+define('PYCODE_FLAG_COMPRESSED', 1);
+define('PYCODE_COMPRESS_THRESHOLD', 1024);
+
+function encodeFrame($kind, $payload, $compress=false) {
+    $flags = 0;
+    if ($compress && strlen($payload) >= PYCODE_COMPRESS_THRESHOLD) {
+        $compressed = gzcompress($payload);
+        if (strlen($compressed) < strlen($payload)) {
+            $payload = $compressed;
+            $flags |= PYCODE_FLAG_COMPRESSED;
+        }
+    }
+    return pack('aCN', $kind, $flags, strlen($payload)) . $payload;
+}
+
+
+// Return the request stream to run the given list of tests on $code,
+// optionally identifying the user and priority class to the grading server.
+// $options is an array of any further spec fields, e.g. runAll.
+function encodeRequest($code, $testlist, $compress=false, $user=null, $priority=null,
+        $options=array()) {
+    $spec = array_merge($options,
+            array('code' => $code, 'tests' => $testlist, 'compress' => $compress));
+    if ($user !== null) {
+        $spec['user'] = $user;
+    }
+    if ($priority !== null) {
+        $spec['priority'] = $priority;
+    }
+    $spec = json_encode($spec);
+    return PYCODE_MAGIC . encodeFrame('S', $spec, $compress);
+}
+
+
+// Return the array of (outcome, output) pairs in a reply stream, or null
+// if the reply is missing, incomplete or corrupt. Anything before the
+// magic number, such as messages from the sandbox, is ignored. A busy
+// reply from the grading server is returned as a single 'Server busy'
+// result.
+function decodeReply($data) {
+    $pos = strpos($data, PYCODE_MAGIC);
+    if ($pos === false) {
+        return null;
+    }
+    $pos += strlen(PYCODE_MAGIC);
+    $results = array();
+    while ($pos + 6 <= strlen($data)) {
+        $header = unpack('akind/Cflags/Nlength', substr($data, $pos, 6));
+        $pos += 6;
+        if ($pos + $header['length'] > strlen($data)) {
+            return null;
+        }
+        $payload = (string) substr($data, $pos, $header['length']);
+        $pos += $header['length'];
+        if ($header['flags'] & PYCODE_FLAG_COMPRESSED) {
+            $payload = gzuncompress($payload);
+            if ($payload === false) {
+                return null;
+            }
+        }
+        if ($header['kind'] == 'E') {
+            return $results;
+        }
+        else if ($header['kind'] == 'R') {
+            $parts = explode("\0", $payload, 2);
+            $results[] = array($parts[0], isset($parts[1]) ? $parts[1] : '');
+        }
+        else if ($header['kind'] == 'B') {
+            return array(array('Server busy',
+                    "*** The grader is busy. Please try again shortly. ***\n"));
+        }
+        else {
+            return null;
+        }
+    }
+    return null;  // No end frame
+}
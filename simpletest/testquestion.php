@@ -64,20 +64,37 @@ class qtype_pycode_question_test extends UnitTestCase {
     public function test_sandbox() {
         $testlist = array(array('double(1)', '2'));
         $code = 'def double(n): return 2 * n';
-        $testsetjson = json_encode(array($code, $testlist));
-    	$testsetencoded = base64_encode($testsetjson);
-        $cmd = "{$GLOBALS['SANDBOX']} \"$testsetencoded\"";
-        $lines = array();
-        try {
-            exec($cmd, $lines);
-    	}
-    	catch (Exception $e) {
-            $err = $e->getMessage();
-            debugging("Exception $err on calling sandboxed pypy");
-    	}
-        //var_dump($lines);
-        $this->assertEqual($lines[0], 'Yes');
-        $this->assertEqual(decodeHex($lines[1]), "2\n");
+        if ($GLOBALS['SANDBOX_PROTOCOL'] == 'framed') {
+            $request = encodeRequest($code, $testlist);
+            $descriptors = array(0 => array('pipe', 'r'), 1 => array('pipe', 'w'));
+            $process = proc_open($GLOBALS['SANDBOX'], $descriptors, $pipes);
+            $this->assertTrue(is_resource($process));
+            fwrite($pipes[0], $request);
+            fclose($pipes[0]);
+            $reply = stream_get_contents($pipes[1]);
+            fclose($pipes[1]);
+            proc_close($process);
+            $results = decodeReply($reply);
+        }
+        else {
+            $results = runSandboxOriginal($code, $testlist);
+        }
+        //var_dump($results);
+        $this->assertEqual(count($results), 1);
+        $this->assertEqual($results[0][0], 'Yes');
+        $this->assertEqual($results[0][1], "2\n");
+    }
+
+
+    public function test_framed_protocol() {
+        $output = str_repeat("x\0y\n", 1000);
+        $reply = "[sandlib: noise]\n" . PYCODE_MAGIC .
+                encodeFrame('R', "Yes\0" . $output, true) .
+                encodeFrame('R', "No\0") . encodeFrame('E', '');
+        $results = decodeReply($reply);
+        $this->assertEqual($results, array(array('Yes', $output), array('No', '')));
+        $this->assertNull(decodeReply(substr($reply, 0, -6)));  // No end frame
+        $this->assertNull(decodeReply('garbage'));
     }
 
 
@@ -96,6 +113,50 @@ class qtype_pycode_question_test extends UnitTestCase {
     }
 
 
+    public function test_regrade_after_testcase_edits() {
+        $q = test_question_maker::make_question('pycode', 'sqr');
+        $response = array('answer' => $this->goodcode);
+        $result = $q->grade_response($response);
+        $this->assertEqual($result[0], 1);
+
+        // Break one expected output and add a new testcase
+        $q->testcases[1]->output = '2';
+        $q->testcases[] = (object) array('testcode' => 'sqr(3)',
+                                         'output'     => '9',
+                                         'useasexample' => 0,
+                                         'display' => 'SHOW',
+                                         'hiderestiffail' =>  0);
+        $response['_testresults'] = $result[2]['_testresults'];
+        $result = $q->grade_response($response);
+        $this->assertEqual($result[0], 0);
+        $this->assertEqual($result[1], question_state::$gradedwrong);
+        $testResults = unserialize($result[2]['_testresults']);
+        $this->assertEqual(count($testResults), count($q->testcases));
+        $this->assertFalse($testResults[1]->isCorrect);
+        $this->assertEqual($testResults[1]->outcome, 'No');
+        $this->assertTrue($testResults[count($testResults) - 1]->isCorrect);
+    }
+
+
+    public function test_fail_fast_grading() {
+        $q = test_question_maker::make_question('pycode', 'sqr');
+        $q->gradingpriority = 'regrade';
+        $failFastPriorities = $GLOBALS['FAIL_FAST_PRIORITIES'];
+        $GLOBALS['FAIL_FAST_PRIORITIES'] = array('regrade');
+        $keys = array_keys($q->testcases);
+        $q->testcases[$keys[3]]->runs = 10;   // sqr(-7): the likeliest to fail
+        $q->testcases[$keys[3]]->failures = 8;
+        $code = "def sqr(x): return x * abs(x)";  // Wrong for negative x
+        $result = $q->grade_response(array('answer' => $code));
+        $GLOBALS['FAIL_FAST_PRIORITIES'] = $failFastPriorities;
+        $this->assertEqual($result[0], 0);
+        $testResults = unserialize($result[2]['_testresults']);
+        $this->assertEqual(count($testResults), 1);  // Decided by the first test run
+        $this->assertEqual($testResults[0]->testindex, 3);
+        $this->assertFalse($testResults[0]->isCorrect);
+    }
+
+
     public function test_grade_response_wrong_ans() {
         $q = test_question_maker::make_question('pycode', 'sqr');
         $code = "def sqr(x): return x * x * x / abs(x)";
@@ -1,4 +1,4 @@
 <?php
 
-$plugin->version  = 2012073001;
+$plugin->version  = 2012073004;
 $plugin->requires = 2011070102;